@@ -0,0 +1,257 @@
+"""
+Non-interactive batch mode: `chatgpt-cli batch`.
+
+Prompts are read from a JSONL file (or stdin), one request per line, and sent
+concurrently through the shared request engine with the same configuration,
+default prompt and templates as the interactive mode. Each line is either a
+plain prompt, or an object such as
+
+    {"id": "q1", "prompt": "...", "template": "alias"}
+    {"id": "q2", "messages": [{"role": "user", "content": "..."}]}
+
+Results are written as JSONL in completion order, each one carrying the `id`
+of its input line (its line number if none is given).
+"""
+import asyncio
+import json
+import sys
+import time
+from typing import Dict, Iterable, List, TextIO
+
+from rich.console import Console
+
+from chatgpt_cli.cache import cache_key, get_response_cache
+from chatgpt_cli.client import get_engine
+from chatgpt_cli.context import count_tokens, get_context_manager
+from chatgpt_cli.ratelimit import (
+    RateLimiter,
+    get_rate_limiter,
+    get_reply_tokens,
+    set_model_budget,
+)
+from chatgpt_cli.retry import get_retry_policy
+from utils.templates import get_template_registry
+
+DEFAULT_BATCH_OPTIONS = {
+    "concurrency": 4,  # requests in flight at the same time
+}
+
+_options = dict(DEFAULT_BATCH_OPTIONS)
+
+# results may be written to stdout, so progress goes to stderr
+stderr = Console(stderr=True)
+
+
+def setup_batch(options: Dict) -> None:
+    """Apply the `batch` section of `config.yaml`"""
+    options = options or {}
+    for key in DEFAULT_BATCH_OPTIONS:
+        if options.get(key) is not None:
+            _options[key] = options[key]
+
+
+def get_batch_options() -> Dict:
+    return dict(_options)
+
+
+def parse_requests(
+    lines: Iterable[str],
+    default_prompt: List[Dict],
+    template: str = None,
+) -> Iterable[Dict]:
+    """
+    Turn input lines into requests `{"id", "messages"}`, or `{"id", "error"}`
+    for lines that cannot be used. Empty lines are skipped.
+    """
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except json.JSONDecodeError:
+            item = line
+        if not isinstance(item, dict):
+            item = {"prompt": item if isinstance(item, str) else line}
+        request = {"id": item.get("id", lineno)}
+        if isinstance(item.get("messages"), list):
+            request["messages"] = item["messages"]
+            yield request
+            continue
+        if not isinstance(item.get("prompt"), str):
+            request["error"] = "expected a `prompt` string or a `messages` list"
+            yield request
+            continue
+        prompt = default_prompt
+        key = item.get("template", template)
+        if key:
+            found = get_template_registry().get(key)
+            if found is None:
+                request["error"] = f"template `{key}` not found"
+                yield request
+                continue
+            prompt = found["prompts"]
+        request["messages"] = [dict(m) for m in prompt] + [
+            {"role": "user", "content": item["prompt"]}
+        ]
+        yield request
+
+
+class BatchRunner:
+    def __init__(
+        self,
+        model: str,
+        out: TextIO,
+        concurrency: int = DEFAULT_BATCH_OPTIONS["concurrency"],
+        limiter: RateLimiter = None,
+        reply_tokens: int = 256,
+    ) -> None:
+        self.model = model
+        self.out = out
+        self.concurrency = max(int(concurrency), 1)
+        self.limiter = limiter or RateLimiter()
+        self.reply_tokens = int(reply_tokens)
+        self.succeeded = 0
+        self.failed = 0
+
+    def __write(self, result: Dict) -> None:
+        self.out.write(json.dumps(result, ensure_ascii=False) + "\n")
+        self.out.flush()
+        if result.get("error") is None:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+
+    async def __complete(self, messages: List[Dict]) -> Dict:
+        import openai
+
+        engine = get_engine()
+        policy = get_retry_policy()
+        # the limiter locks and reads its state file, off the event loop
+        loop = asyncio.get_running_loop()
+        reserved = count_tokens(messages, self.model) + self.reply_tokens
+        attempt = 0
+        while True:
+            attempt += 1
+            delay = await loop.run_in_executor(None, self.limiter.reserve, reserved)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                response = await engine.acreate(
+                    model=self.model, messages=messages, stream=False
+                )
+            except openai.error.OpenAIError as err:
+                await loop.run_in_executor(None, self.limiter.settle, reserved, 0)
+                delay = policy.delay(err, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                continue
+            usage = response.get("usage") or {}
+            await loop.run_in_executor(
+                None, self.limiter.settle, reserved, usage.get("total_tokens")
+            )
+            return response
+
+    async def __run_one(self, request: Dict) -> None:
+        result = {"id": request["id"]}
+        start = time.monotonic()
+        try:
+            if "error" in request:
+                raise ValueError(request["error"])
+            messages = get_context_manager().fit(request["messages"], self.model)
+            cache = get_response_cache()
+            key = cache_key(self.model, {}, messages) if cache is not None else None
+            # the cache reads and writes SQLite, off the event loop
+            loop = asyncio.get_running_loop()
+            content = None
+            if cache is not None:
+                content = await loop.run_in_executor(None, cache.get, key)
+            if content is not None:
+                result["response"] = content
+                result["cached"] = True
+            else:
+                response = await self.__complete(messages)
+                content = response["choices"][0]["message"]["content"]
+                if cache is not None:
+                    await loop.run_in_executor(
+                        None, cache.put, key, self.model, content
+                    )
+                result["response"] = content
+                result["usage"] = dict(response.get("usage") or {})
+            result["error"] = None
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+        result["elapsed"] = round(time.monotonic() - start, 3)
+        self.__write(result)
+
+    async def run(self, requests: Iterable[Dict]) -> None:
+        """Run all `requests` with at most `concurrency` of them in flight"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+
+        async def run_one(request: Dict) -> None:
+            try:
+                await self.__run_one(request)
+            finally:
+                semaphore.release()
+
+        try:
+            for request in requests:
+                await semaphore.acquire()
+                task = asyncio.ensure_future(run_one(request))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+def run_batch(
+    default_prompt: List[Dict],
+    input_path: str = "-",
+    output_path: str = "-",
+    model: str = "gpt-3.5-turbo",
+    template: str = None,
+    concurrency: int = None,
+    requests_per_minute: float = None,
+    tokens_per_minute: float = None,
+) -> None:
+    """Entry point of `chatgpt-cli batch`, options default to `config.yaml`"""
+    options = get_batch_options()
+    if concurrency is not None:
+        options["concurrency"] = concurrency
+    if requests_per_minute is not None or tokens_per_minute is not None:
+        set_model_budget(model, requests_per_minute, tokens_per_minute)
+    try:
+        fin = sys.stdin if input_path == "-" else open(input_path, "r")
+        fout = sys.stdout if output_path == "-" else open(output_path, "a")
+    except OSError as e:
+        stderr.print(f"[Error]: {e}", markup=False)
+        exit(1)
+    # all lines are read up front, so reading stdin never blocks the engine loop
+    requests = list(parse_requests(fin, default_prompt, template))
+    runner = BatchRunner(
+        model,
+        fout,
+        concurrency=options["concurrency"],
+        limiter=get_rate_limiter(model),
+        reply_tokens=get_reply_tokens(),
+    )
+    start = time.monotonic()
+    engine = get_engine()
+    future = asyncio.run_coroutine_threadsafe(runner.run(requests), engine.loop)
+    try:
+        future.result()
+    except KeyboardInterrupt:
+        future.cancel()
+        stderr.print("Aborting")
+    finally:
+        for f in [fin, fout]:
+            if f not in [sys.stdin, sys.stdout]:
+                f.close()
+    stderr.print(
+        f"{runner.succeeded} succeeded, {runner.failed} failed in {time.monotonic() - start:.1f}s"
+    )
@@ -0,0 +1,126 @@
+"""
+On-disk cache of chat completions.
+
+Replies are stored in `cache.db` in the config directory, keyed by a hash of
+the model, the request parameters and the exact messages sent. Entries expire
+after `ttl` seconds, and the least recently used ones are evicted once there
+are more than `max_entries`. The cache is opt-in, and `!regen` always asks the
+API for a fresh reply.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Dict, List, Optional
+
+from chatgpt_cli.context import prefix_digests
+from utils.settings import get_config_dir
+from utils.store import connect
+
+DEFAULT_CACHE_OPTIONS = {
+    "enabled": False,
+    "ttl": 7 * 24 * 3600,  # seconds a reply is reused, forever if 0
+    "max_entries": 1000,  # least recently used replies are evicted beyond this
+}
+
+CACHE_FILENAME = "cache.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created REAL NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed);
+"""
+
+_options = dict(DEFAULT_CACHE_OPTIONS)
+_cache = None
+
+
+def cache_key(
+    model: str,
+    params: Dict,
+    messages: List[Dict[str, str]] = None,
+    digest: str = None,
+) -> str:
+    """
+    Stable hash of a request, `params` are e.g. `{"temperature": 0.7}`. The
+    rolling `digest` of the messages can be given instead of `messages` when
+    it is already known (see `PrefixChain`).
+    """
+    if digest is None:
+        digests = prefix_digests(messages)
+        digest = digests[-1] if digests else ""
+    request = {"model": model, "params": params, "messages": digest}
+    data = json.dumps(request, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path: str, ttl: float = 0, max_entries: int = 1000) -> None:
+        self.path = path
+        self.ttl = float(ttl or 0)
+        self.max_entries = int(max_entries)
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        return connect(self.path, SCHEMA)
+
+    def get(self, key: str) -> Optional[str]:
+        """The cached reply for `key`, or None if there is no fresh one"""
+        now = time.time()
+        with self.conn as conn:
+            row = conn.execute(
+                "SELECT content, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if self.ttl and row["created"] < now - self.ttl:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        return row["content"]
+
+    def put(self, key: str, model: str, content: str) -> None:
+        now = time.time()
+        with self.conn as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, model, content, now, now),
+            )
+            if self.ttl:
+                conn.execute(
+                    "DELETE FROM responses WHERE created < ?", (now - self.ttl,)
+                )
+            conn.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+
+def setup_cache(options: Dict) -> None:
+    """Apply the `cache` section of `config.yaml`"""
+    global _cache
+    options = options or {}
+    for key in DEFAULT_CACHE_OPTIONS:
+        if options.get(key) is not None:
+            _options[key] = options[key]
+    _cache = None
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    """Return the shared cache, or None if it is disabled"""
+    global _cache
+    if not _options["enabled"]:
+        return None
+    if _cache is None:
+        _cache = ResponseCache(
+            os.path.join(get_config_dir(), CACHE_FILENAME),
+            _options["ttl"],
+            _options["max_entries"],
+        )
+    return _cache
@@ -1,7 +1,14 @@
-import openai
+import argparse
 import os
 
-from chatgpt_cli.conversation import generate_response
+from chatgpt_cli.cache import setup_cache
+from chatgpt_cli.client import set_api_key, setup_client
+from chatgpt_cli.context import setup_context
+from chatgpt_cli.conversation import DEFAULT_MODEL, generate_response
+from chatgpt_cli.profile import exit_before_prompt, profile_startup
+from chatgpt_cli.ratelimit import setup_rate_limit
+from chatgpt_cli.retry import setup_retry
+from utils.autosave import setup_autosave
 from utils.cmd import *
 from utils.file import *
 from utils.io import *
@@ -15,21 +22,23 @@ def setup_runtime_env() -> Dict:
     config = load_config()
     try:
         # set up openai API key and system prompt
-        openai.api_key = config["openai"]["api_key"]
+        set_api_key(config["openai"]["api_key"])
         # set proxy if defined
-        if "proxy" in config:
-            os.environ["http_proxy"] = config["proxy"].get("http_proxy", "")
-            os.environ["https_proxy"] = config["proxy"].get("https_proxy", "")
-
-        default_prompt = config.get("openai", {}).get("default_prompt", None)
-        if default_prompt is None:
-            raise (Exception("Error: the `default_prompt` is empty in `config.yaml`"))
-        elif type(default_prompt) is not list:
-            raise (
-                Exception("Error: the `default_prompt` is not a list in `config.yaml`")
-            )
-    except Exception:
+        if config.get("proxy"):
+            os.environ["http_proxy"] = config["proxy"].get("http_proxy") or ""
+            os.environ["https_proxy"] = config["proxy"].get("https_proxy") or ""
+        # set up the shared request engine (connection pool and timeouts)
+        setup_client(config.get("client", {}))
+        setup_retry(config.get("retry", {}))
+        setup_rate_limit(config.get("rate_limit", {}))
+        setup_cache(config.get("cache", {}))
+        setup_context(config.get("context", {}))
+        setup_storage(config.get("storage", {}))
+        setup_autosave(config.get("storage", {}))
+        # `default_prompt` itself is validated by `load_config`
+    except Exception as e:
         print("Error in configuration file:", get_config_path())
+        printmd(f"**[Error]**: {e}")
         exit(1)
     return config
 
@@ -43,6 +52,7 @@ def read_message(conv, tmpl, use_streaming):
         user_message = post_command_process(user_message)
 
     if user_message == "":
+        conv.autosave()
         return
 
     conv.add_user_message(user_message)
@@ -50,11 +60,15 @@ def read_message(conv, tmpl, use_streaming):
 
     if use_streaming == True:
         assistant_message = assistant_stream(
-            generate_response(conv.messages, use_streaming)
+            generate_response(
+                conv.messages, use_streaming, digest=conv.digest(), model=conv.model
+            )
         )
     else:
         assistant_message = "".join(
-            list(generate_response(conv.messages, use_streaming))
+            generate_response(
+                conv.messages, use_streaming, digest=conv.digest(), model=conv.model
+            )
         )
 
     if assistant_message:
@@ -65,7 +79,9 @@ def read_message(conv, tmpl, use_streaming):
         conv.save(True)
 
     if use_streaming:
-        conv.show_history()
+        conv.show_history(start=conv.history_window())
+
+    conv.autosave()
 
 
 def loop(conv, tmpl, use_streaming):
@@ -77,17 +93,95 @@ def loop(conv, tmpl, use_streaming):
         input_error_handler(conv.modified, e)
 
 
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog="chatgpt-cli",
+        description="A markdown-supported command-line interface tool for ChatGPT.",
+    )
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="show how long starting up takes and which imports it is spent on",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    migrate = subparsers.add_parser(
+        "migrate", help="import saved JSON/JSONL conversations into the SQLite store"
+    )
+    migrate.add_argument(
+        "directory",
+        nargs="?",
+        help="directory containing the data files (defaults to the data directory)",
+    )
+    importer = subparsers.add_parser(
+        "import", help="import the conversations of another data directory"
+    )
+    importer.add_argument("directory", help="directory containing the data files")
+    importer.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        help="worker processes reading the files (defaults to the number of CPUs)",
+    )
+    batch = subparsers.add_parser(
+        "batch", help="run prompts from a JSONL file non-interactively"
+    )
+    batch.add_argument(
+        "input",
+        nargs="?",
+        default="-",
+        help="JSONL file of prompts (defaults to stdin)",
+    )
+    batch.add_argument(
+        "-o", "--output", default="-", help="JSONL file to append results to"
+    )
+    batch.add_argument("-m", "--model", help="model to use (defaults to `chat.model`)")
+    batch.add_argument("-t", "--template", help="template name or alias to prompt with")
+    batch.add_argument("-c", "--concurrency", type=int, help="requests in flight")
+    batch.add_argument("--rpm", type=float, help="requests per minute budget")
+    batch.add_argument("--tpm", type=float, help="tokens per minute budget")
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
+    if args.profile_startup:
+        profile_startup()
+        return
     config = setup_runtime_env()
+    model = config.get("chat", {}).get("model") or DEFAULT_MODEL
+    if args.command == "migrate":
+        migrate_data_directory(args.directory)
+        return
+    if args.command == "import":
+        import_data_directory(args.directory, args.jobs)
+        return
+    if args.command == "batch":
+        from chatgpt_cli.batch import run_batch, setup_batch
+
+        setup_batch(config.get("batch", {}))
+        run_batch(
+            config["openai"]["default_prompt"],
+            args.input,
+            args.output,
+            model=args.model or model,
+            template=args.template,
+            concurrency=args.concurrency,
+            requests_per_minute=args.rpm,
+            tokens_per_minute=args.tpm,
+        )
+        return
     use_streaming = config.get("chat", {}).get("use_streaming", False)
+    set_stream_refresh_rate(config.get("chat", {}).get("refresh_per_second"))
 
     default_prompt = config["openai"]["default_prompt"]
     show_welcome_panel()
 
-    conv = Conversation(default_prompt, use_streaming)
+    conv = Conversation(default_prompt, use_streaming, model)
     conv.show_history()
 
     tmpl = Template()
+    if exit_before_prompt():
+        return
     while True:
         loop(conv, tmpl, use_streaming)
 
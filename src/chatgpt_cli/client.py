@@ -0,0 +1,211 @@
+"""
+Request engine shared by every request path.
+
+All chat completions run on one asyncio event loop living in a background
+thread. The loop owns a single `aiohttp.ClientSession` with a keep-alive
+connection pool, so consecutive turns reuse the same TLS connection instead of
+paying for a new handshake, and the calling thread only waits on a queue while
+tokens arrive.
+"""
+import atexit
+import queue
+import threading
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# asyncio, aiohttp and openai are only imported once the engine starts, as
+# they take longer to import than the rest of the CLI together
+
+_CHUNK, _ERROR, _DONE = range(3)
+
+DEFAULT_CLIENT_OPTIONS = {
+    "connect_timeout": 10.0,  # seconds to establish a connection
+    "read_timeout": 600.0,  # seconds for a whole response to complete
+    "pool_size": 8,  # maximum number of pooled connections
+    "keepalive_timeout": 120.0,  # seconds an idle connection is kept open
+}
+
+_options = dict(DEFAULT_CLIENT_OPTIONS)
+_api_key = None
+_engine = None
+
+
+class RequestEngine:
+    def __init__(
+        self,
+        connect_timeout: float = DEFAULT_CLIENT_OPTIONS["connect_timeout"],
+        read_timeout: float = DEFAULT_CLIENT_OPTIONS["read_timeout"],
+        pool_size: int = DEFAULT_CLIENT_OPTIONS["pool_size"],
+        keepalive_timeout: float = DEFAULT_CLIENT_OPTIONS["keepalive_timeout"],
+    ) -> None:
+        self.connect_timeout = float(connect_timeout)
+        self.read_timeout = float(read_timeout)
+        self.pool_size = int(pool_size)
+        self.keepalive_timeout = float(keepalive_timeout)
+        self.session = None  # aiohttp.ClientSession, created on first use
+        import asyncio
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="chatgpt-cli-client", daemon=True
+        )
+        self.thread.start()
+
+    def __get_session(self):
+        """Create the pooled session on first use, must run on the engine loop"""
+        import aiohttp
+
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            # `trust_env` picks up the proxy settings exported from `config.yaml`
+            self.session = aiohttp.ClientSession(connector=connector, trust_env=True)
+        return self.session
+
+    def run(self, coro) -> Any:
+        """Run a coroutine on the engine loop and wait for its result"""
+        import asyncio
+
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def acreate(self, **params) -> Any:
+        """Send a chat completion request, must run on the engine loop"""
+        import openai
+
+        if _api_key is not None:
+            params.setdefault("api_key", _api_key)
+        # the session is picked up by openai through a context variable, which
+        # is local to the task running this coroutine
+        openai.aiosession.set(self.__get_session())
+        return await openai.ChatCompletion.acreate(
+            request_timeout=(self.connect_timeout, self.read_timeout),
+            **params,
+        )
+
+    async def __chat(self, params: Dict, out: queue.Queue, key: int = 0) -> None:
+        import asyncio
+
+        import aiohttp
+        import openai
+
+        try:
+            response = await self.acreate(**params)
+            if params.get("stream", False):
+                # openai only maps the errors of the request itself, a stream
+                # failing while it is read raises the errors of aiohttp
+                try:
+                    async for chunk in response:
+                        out.put((key, _CHUNK, chunk))
+                except asyncio.TimeoutError as e:
+                    raise openai.error.Timeout("Request timed out") from e
+                except aiohttp.ClientError as e:
+                    raise openai.error.APIConnectionError(
+                        "Error communicating with OpenAI"
+                    ) from e
+            else:
+                out.put((key, _CHUNK, response))
+        except Exception as e:
+            out.put((key, _ERROR, e))
+        finally:
+            out.put((key, _DONE, None))
+
+    def chat(self, **params) -> Iterator[Dict]:
+        """
+        Send a chat completion request and iterate over the response.
+
+        Yields every chunk when `stream=True`, or the full response once
+        otherwise. Errors raised by openai are re-raised in the calling thread.
+        Closing the iterator early (e.g. on `Ctrl+C`) cancels the request.
+        """
+        import asyncio
+
+        out = queue.Queue()
+        future = asyncio.run_coroutine_threadsafe(self.__chat(params, out), self.loop)
+        try:
+            while True:
+                _, kind, item = out.get()
+                if kind == _CHUNK:
+                    yield item
+                elif kind == _ERROR:
+                    raise item
+                else:
+                    return
+        finally:
+            future.cancel()
+
+    def chat_many(self, requests: List[Dict]) -> Iterator[Tuple[int, Any]]:
+        """
+        Send several chat completion requests at once and iterate over their
+        chunks as they arrive, as `(i, chunk)` pairs for request `i` (see
+        `chat`). A failed request yields its error instead of raising it, and
+        the others keep running. Closing the iterator cancels all of them.
+        """
+        import asyncio
+
+        out = queue.Queue()
+        futures = [
+            asyncio.run_coroutine_threadsafe(self.__chat(params, out, i), self.loop)
+            for i, params in enumerate(requests)
+        ]
+        running = len(futures)
+        try:
+            while running:
+                i, kind, item = out.get()
+                if kind == _DONE:
+                    running -= 1
+                else:
+                    yield i, item
+        finally:
+            for future in futures:
+                future.cancel()
+
+    async def __close(self) -> None:
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+    def close(self) -> None:
+        """Close pooled connections and stop the engine loop"""
+        if self.loop.is_closed():
+            return
+        try:
+            self.run(self.__close())
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout=1)
+            if not self.loop.is_running():
+                self.loop.close()
+
+
+def set_api_key(api_key: str) -> None:
+    """Set the API key sent with every request"""
+    global _api_key
+    _api_key = api_key
+
+
+def setup_client(options: Dict) -> None:
+    """Apply the `client` section of `config.yaml` before the engine starts"""
+    global _engine
+    options = options or {}
+    for key in DEFAULT_CLIENT_OPTIONS:
+        if options.get(key) is not None:
+            _options[key] = options[key]
+    if _engine is not None:
+        _engine.close()
+        _engine = None
+
+
+def get_engine() -> RequestEngine:
+    """Return the shared request engine, starting it on first use"""
+    global _engine
+    if _engine is None:
+        _engine = RequestEngine(**_options)
+    return _engine
+
+
+@atexit.register
+def close_engine() -> None:
+    global _engine
+    if _engine is not None:
+        _engine.close()
+        _engine = None
@@ -0,0 +1,100 @@
+"""
+Latency of the models compared with `!compare model-a,model-b`.
+
+Every model gets the same messages at the same moment, and its reply is timed
+from that moment: the time to the first token, the total time, and the tokens
+per second generated after the first token (over the whole request without
+streaming, where the reply arrives at once). Each run is shown as a table and
+appended to `compare.jsonl` in the config directory.
+"""
+import json
+import os
+import time
+from typing import Dict, List, Optional
+
+from utils.io import print, printmd
+from utils.settings import get_config_dir
+
+COMPARE_LOG_FILENAME = "compare.jsonl"
+
+
+class ModelStats:
+    def __init__(self, model: str) -> None:
+        self.model = model
+        self.start: Optional[float] = None  # when the request was sent
+        self.first: Optional[float] = None  # when the first token arrived
+        self.end: Optional[float] = None  # when the last token arrived
+        self.tokens = 0
+        self.streamed = True
+        self.error: Optional[str] = None
+
+    @property
+    def ttft(self) -> Optional[float]:
+        """Seconds to the first token"""
+        if self.first is None:
+            return None
+        return self.first - self.start
+
+    @property
+    def total(self) -> Optional[float]:
+        """Seconds to the last token"""
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        if self.first is None or not self.tokens:
+            return None
+        elapsed = self.end - self.first if self.streamed else self.total
+        return self.tokens / elapsed if elapsed > 0 else None
+
+    def to_dict(self) -> Dict:
+        return {
+            "model": self.model,
+            "streamed": self.streamed,
+            "ttft": self.ttft,
+            "total": self.total,
+            "tokens": self.tokens,
+            "tokens_per_second": self.tokens_per_second,
+            "error": self.error,
+        }
+
+
+def _seconds(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value:.2f}s"
+
+
+def show_stats(stats: List[ModelStats]) -> None:
+    from rich.markup import escape
+    from rich.table import Table
+
+    table = Table("Model", "First token", "Total", "Tokens", "Tokens/s", "Error")
+    for s in stats:
+        rate = s.tokens_per_second
+        table.add_row(
+            escape(s.model),
+            _seconds(s.ttft),
+            _seconds(s.total),
+            str(s.tokens) if s.tokens else "-",
+            "-" if rate is None else f"{rate:.1f}",
+            escape(s.error or ""),
+        )
+    print(table)
+    done = [s for s in stats if s.error is None and s.total is not None]
+    if len(done) > 1:
+        fastest = min(done, key=lambda s: s.total)
+        printmd(f"**Fastest: `{fastest.model}` in {fastest.total:.2f}s.**")
+
+
+def log_stats(stats: List[ModelStats]) -> None:
+    """Append a comparison to `compare.jsonl`"""
+    path = os.path.join(get_config_dir(), COMPARE_LOG_FILENAME)
+    run = time.time()
+    try:
+        with open(path, "a", encoding="utf-8") as f:
+            for s in stats:
+                record = dict(s.to_dict(), time=run)
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    except OSError as e:
+        printmd(f"**[Warning]**: Failed to record the comparison in `{path}`: {e}")
@@ -0,0 +1,297 @@
+"""
+Context window management.
+
+Before each request the conversation is fitted into the token budget of the
+model: leading system messages, pinned messages and the latest message are
+always sent, and older messages are left out (or summarized) according to the
+configured policy.
+"""
+import functools
+import hashlib
+import json
+import re
+from typing import Callable, Dict, List, Optional
+
+POLICIES = ["none", "sliding_window", "last_n", "summarize"]
+
+DEFAULT_CONTEXT_OPTIONS = {
+    "policy": "sliding_window",
+    "last_n": 20,  # messages kept by the `last_n` policy, besides system/pinned
+    "reserve_tokens": 512,  # room left for the reply
+    "summary_tokens": 256,  # room left for the summary of older turns
+    "max_tokens": {
+        "gpt-3.5-turbo": 4096,
+        "gpt-4": 8192,
+        "gpt-4-32k": 32768,
+    },
+}
+
+# tokens added by the chat format for every message, and to prime the reply
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+
+# keys of a message that are understood by the API, others are local metadata
+REQUEST_KEYS = ["role", "content", "name"]
+
+SUMMARY_PROMPT = "Summarize the conversation below in a few sentences. Keep names, facts, decisions and open questions that later messages may refer to."
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+# model whose encoding counted the stored tokens of messages saved without one
+COUNT_MODEL = "gpt-3.5-turbo"
+
+_WORD_PATTERN = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+_options = dict(DEFAULT_CONTEXT_OPTIONS)
+_manager = None
+
+
+@functools.lru_cache(maxsize=None)
+def _get_tiktoken():
+    """tiktoken if installed (imported on first use, as it is slow to import)"""
+    try:
+        import tiktoken
+    except ImportError:  # optional, fall back to a fast local estimate
+        return None
+    return tiktoken
+
+
+@functools.lru_cache(maxsize=None)
+def _get_encoding(model: str):
+    tiktoken = _get_tiktoken()
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+@functools.lru_cache(maxsize=None)
+def encoding_name(model: str) -> str:
+    """Name of the encoding counting the tokens of `model`"""
+    if _get_tiktoken() is None:
+        return "estimate"
+    return _get_encoding(model).name
+
+
+@functools.lru_cache(maxsize=8192)
+def count_text_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
+    """Count the tokens of `text`, cached so repeated messages are not recounted"""
+    if _get_tiktoken() is not None:
+        return len(_get_encoding(model).encode(text))
+    # without tiktoken: long words are split into ~4 character pieces, which
+    # is close to what BPE does for English text and code
+    count = 0
+    for word in _WORD_PATTERN.findall(text):
+        count += (len(word) + 3) // 4 if word.isascii() else len(word)
+    return count
+
+
+def count_message_tokens(message: Dict[str, str], model: str = "gpt-3.5-turbo") -> int:
+    """
+    Tokens of a message, using the count stored in it by `Conversation` if it
+    was counted with the encoding of `model`
+    """
+    if message.get("tokens") is not None:
+        encoding = message.get("encoding") or encoding_name(COUNT_MODEL)
+        if encoding == encoding_name(model):
+            return message["tokens"]
+    count = MESSAGE_OVERHEAD
+    for key in REQUEST_KEYS:
+        if message.get(key):
+            count += count_text_tokens(message[key], model)
+    return count
+
+
+def count_tokens(messages: List[Dict[str, str]], model: str = "gpt-3.5-turbo") -> int:
+    return REPLY_OVERHEAD + sum(count_message_tokens(m, model) for m in messages)
+
+
+def request_messages(messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """Strip local metadata (e.g. `pinned`) the API would reject"""
+    return [{k: m[k] for k in REQUEST_KEYS if k in m} for m in messages]
+
+
+def message_digest(previous: str, message: Dict[str, str]) -> str:
+    """Rolling hash of a message list: `previous` messages, then `message`"""
+    data = json.dumps(
+        {k: message[k] for k in REQUEST_KEYS if k in message},
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha1((previous + data).encode("utf-8")).hexdigest()
+
+
+def prefix_digests(messages: List[Dict[str, str]]) -> List[str]:
+    """Rolling hash of every prefix of `messages`"""
+    digests = []
+    for message in messages:
+        digests.append(message_digest(digests[-1] if digests else "", message))
+    return digests
+
+
+class PrefixChain:
+    """
+    Rolling hashes and running token totals of the prefixes of a message list,
+    so hashing or counting the whole list only costs the messages appended
+    since the last call. The owner of the list must `truncate` the chain at
+    the first message it changes or removes. Tokens are counted for `model`.
+    """
+
+    def __init__(self, model: str = "gpt-3.5-turbo") -> None:
+        self.model = model
+        self.digests: List[str] = []
+        self.totals: List[int] = []
+
+    def truncate(self, index: int = 0) -> None:
+        del self.digests[index:]
+        del self.totals[index:]
+
+    def update(self, messages: List[Dict[str, str]]) -> None:
+        for i in range(len(self.digests), len(messages)):
+            previous = self.digests[i - 1] if i else ""
+            total = self.totals[i - 1] if i else 0
+            self.digests.append(message_digest(previous, messages[i]))
+            self.totals.append(total + count_message_tokens(messages[i], self.model))
+
+    def digest(self, messages: List[Dict[str, str]]) -> str:
+        """Hash of `messages`, a prefix of the list owning the chain"""
+        self.update(messages)
+        return self.digests[len(messages) - 1] if messages else ""
+
+    def tokens(self, messages: List[Dict[str, str]]) -> int:
+        """Tokens of `messages`, a prefix of the list owning the chain"""
+        self.update(messages)
+        return self.totals[len(messages) - 1] if messages else 0
+
+
+class ContextManager:
+    def __init__(self, options: Dict = None) -> None:
+        self.options = dict(DEFAULT_CONTEXT_OPTIONS)
+        self.options.update(options or {})
+        self.max_tokens = dict(DEFAULT_CONTEXT_OPTIONS["max_tokens"])
+        self.max_tokens.update((options or {}).get("max_tokens") or {})
+        if self.options["policy"] not in POLICIES:
+            raise ValueError(
+                f"Invalid context policy `{self.options['policy']}`, expected one of {POLICIES}"
+            )
+        self.summaries: Dict[str, str] = {}
+        self.dropped = 0  # messages left out by the last call to `fit`
+
+    def budget(self, model: str) -> int:
+        """Tokens available for the messages sent to `model`"""
+        limit = self.max_tokens.get(model)
+        if limit is None:
+            # e.g. `gpt-3.5-turbo-0301` falls back to `gpt-3.5-turbo`
+            prefixes = [m for m in self.max_tokens if model.startswith(m)]
+            limit = self.max_tokens[max(prefixes, key=len)] if prefixes else 4096
+        return int(limit) - int(self.options["reserve_tokens"])
+
+    def fit(
+        self,
+        messages: List[Dict[str, str]],
+        model: str,
+        summarize: Callable[[List[Dict[str, str]]], str] = None,
+    ) -> List[Dict[str, str]]:
+        """
+        Return the messages to send to `model`, within its token budget.
+
+        `summarize` turns a list of messages into a summary, it is only used by
+        the `summarize` policy.
+        """
+        policy = self.options["policy"]
+        self.dropped = 0
+        if policy == "none" or not messages:
+            return request_messages(messages)
+
+        # leading system messages, pinned messages and the last message are kept
+        leading = 0
+        while leading < len(messages) and messages[leading]["role"] == "system":
+            leading += 1
+        required = set(range(leading))
+        required.update(i for i, m in enumerate(messages) if m.get("pinned"))
+        required.add(len(messages) - 1)
+
+        budget = self.budget(model)
+        if policy == "summarize":
+            budget -= int(self.options["summary_tokens"])
+        used = REPLY_OVERHEAD + sum(
+            count_message_tokens(messages[i], model) for i in required
+        )
+        limit = len(messages)
+        if policy == "last_n":
+            limit = int(self.options["last_n"])
+
+        # slide the window back from the latest message until the budget is spent
+        kept = set(required)
+        window = 0
+        for i in range(len(messages) - 1, leading - 1, -1):
+            if i in required:
+                continue
+            tokens = count_message_tokens(messages[i], model)
+            if window >= limit or used + tokens > budget:
+                break
+            kept.add(i)
+            used += tokens
+            window += 1
+        dropped = [m for i, m in enumerate(messages) if i not in kept]
+        if not dropped:
+            return request_messages(messages)
+        self.dropped = len(dropped)
+
+        selected = [m for i, m in enumerate(messages) if i in kept]
+        if policy == "summarize" and summarize is not None:
+            summary = self.summary(dropped, summarize)
+            if summary:
+                note = {"role": "system", "content": SUMMARY_PREFIX + summary}
+                selected.insert(leading, note)
+        return request_messages(selected)
+
+    def summary(
+        self,
+        dropped: List[Dict[str, str]],
+        summarize: Callable[[List[Dict[str, str]]], str],
+    ) -> Optional[str]:
+        """
+        Summary of `dropped`, extending the summary of its longest summarized
+        prefix so a sliding window only summarizes the newly dropped messages.
+        """
+        keys = prefix_digests(dropped)
+        if keys[-1] in self.summaries:
+            return self.summaries[keys[-1]]
+        start, previous = 0, None
+        for i in range(len(keys) - 2, -1, -1):
+            if keys[i] in self.summaries:
+                start, previous = i + 1, self.summaries[keys[i]]
+                break
+        pending = list(dropped[start:])
+        if previous:
+            pending.insert(0, {"role": "system", "content": SUMMARY_PREFIX + previous})
+        summary = summarize(pending)
+        if summary:
+            self.summaries[keys[-1]] = summary
+        return summary
+
+
+def summary_request(messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """Messages asking the model to summarize `messages`"""
+    transcript = "\n\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    return [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": transcript},
+    ]
+
+
+def setup_context(options: Dict) -> None:
+    """Apply the `context` section of `config.yaml`"""
+    global _manager
+    options = options or {}
+    for key in DEFAULT_CONTEXT_OPTIONS:
+        if options.get(key) is not None:
+            _options[key] = options[key]
+    _manager = None
+
+
+def get_context_manager() -> ContextManager:
+    global _manager
+    if _manager is None:
+        _manager = ContextManager(_options)
+    return _manager
@@ -1,91 +1,446 @@
 from datetime import datetime
-from typing import List
+from typing import Iterator, List, MutableSequence, Optional, Tuple
 
-import openai
+import itertools
 import os
+import time
 
+from chatgpt_cli.cache import cache_key, get_response_cache
+from chatgpt_cli.client import get_engine
+from chatgpt_cli.compare import ModelStats, log_stats, show_stats
+from chatgpt_cli.context import (
+    PrefixChain,
+    count_message_tokens,
+    count_text_tokens,
+    count_tokens,
+    encoding_name,
+    get_context_manager,
+    summary_request,
+)
+from chatgpt_cli.ratelimit import get_rate_limiter, get_reply_tokens
+from chatgpt_cli.retry import get_retry_policy
+from utils.autosave import get_autosave_writer
 from utils.file import *
+from utils.journal import BranchTree, LazyMessages, shared_prefix
+from utils.templates import TemplateRegistry, get_template_registry
 
 
-def generate_response(messages: List[Dict[str, str]], use_streaming: bool) -> str:
-    try:
-        with console.status("[bold green]Preparing response..."):
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo",  # or gpt-3.5-turbo-0301
-                messages=messages,
-                stream=use_streaming,
-            )
+ERROR_HINTS = {
+    "APIConnectionError": "**[API Connection Error]**\nPlease check your internet connection and try again.",
+    "InvalidRequestError": "**[Invalid Request Error]**\nPlease revise your messages according to the error message above.",
+    "APIError": "**[API Error]**\nThis might be caused by API outage. Please try again later.",
+    "RateLimitError": "**[Rate Limit Error]**\nThis is caused by API outage. Please try again later.",
+}
+UNKNOWN_ERROR_HINT = "**[Unknown Error]**\nThis is an unknown error, please contact maintainer with error message to help handle it properly."
 
-        if use_streaming:
-            for chunk in response:
-                if "content" not in chunk["choices"][0]["delta"]:
-                    continue
-                yield (chunk["choices"][0]["delta"]["content"])
-        else:
-            yield response["choices"][0]["message"]["content"].strip()
+# model of new conversations unless `chat.model` is set in `config.yaml`
+DEFAULT_MODEL = "gpt-3.5-turbo"  # or gpt-3.5-turbo-0301
 
-    except openai.error.APIConnectionError as api_conn_err:
-        print(api_conn_err)
-        printpnl(
-            "**[API Connection Error]**\n. Please check your internet connection and try again."
-        )
-        user_message = input("Do you want to retry now? (y/n): ")
-        if user_message.strip().lower() == "y":
-            return generate_response(messages, use_streaming)
-        else:
-            return ""
-    except openai.error.InvalidRequestError as invalid_err:
-        print(invalid_err)
-        printpnl(
-            "**[Invalid Request Error]**\nPlease revise your messages according to the error message above."
-        )
-        return ""
-    except openai.error.APIError as api_err:
-        print(api_err)
-        printpnl(
-            "**[API Error]**\nThis might be caused by API outage. Please try again later."
-        )
-        user_message = input("Do you want to retry now? (y/n): ")
-        if user_message.strip().lower() == "y":
-            return generate_response(messages, use_streaming)
-        else:
+
+def error_hint(err: Exception) -> str:
+    return ERROR_HINTS.get(type(err).__name__, UNKNOWN_ERROR_HINT)
+
+
+def wait_for_rate_limit(
+    messages: List[Dict[str, str]], model: str, replies: int = 1
+) -> int:
+    """
+    Reserve a request to `model` from its rate limiter and wait until it may be
+    sent. Return the tokens reserved for it (prompt and expected replies).
+    """
+    limiter = get_rate_limiter(model)
+    if not limiter.limited:
+        return 0
+    tokens = count_tokens(messages, model) + get_reply_tokens() * replies
+    delay = limiter.reserve(tokens)
+    if delay > 0:
+        status = f"[bold yellow]Waiting {delay:.1f}s for the rate limit of {model}..."
+        with console.status(status):
+            time.sleep(delay)
+    return tokens
+
+
+def settle_rate_limit(model: str, reserved: int, used: int) -> None:
+    """Correct the tokens reserved by `wait_for_rate_limit` once known"""
+    if reserved:
+        get_rate_limiter(model).settle(reserved, used)
+
+
+def summarize_messages(messages: List[Dict[str, str]], model: str) -> str:
+    """Summarize older messages for the `summarize` context policy"""
+    try:
+        request = summary_request(messages)
+        reserved = wait_for_rate_limit(request, model)
+        with console.status("[bold green]Summarizing earlier messages..."):
+            chunks = get_engine().chat(model=model, messages=request, stream=False)
+            response = next(chunks, None)
+        if response is None:
+            settle_rate_limit(model, reserved, 0)
             return ""
-    except openai.error.RateLimitError as rate_err:
-        print(rate_err)
-        printpnl(
-            "**[Rate Limit Error]**\nThis is caused by API outage. Please try again later."
+        settle_rate_limit(
+            model, reserved, response.get("usage", {}).get("total_tokens")
         )
-        user_message = input("Do you want to retry now? (y/n): ")
-        if user_message.strip().lower() == "y":
-            return generate_response(messages, use_streaming)
-        else:
-            return ""
+        return response["choices"][0]["message"]["content"].strip()
     except Exception as e:
         print(e)
-        printpnl(
-            "**[Unknown Error]**\nThis is an unknown error, please contact maintainer with error message to help handle it properly."
-        )
+        printmd("**[Warning]**: Failed to summarize earlier messages, leaving them out")
         return ""
 
 
+def fit_request(messages: List[Dict[str, str]], model: str) -> List[Dict[str, str]]:
+    """The messages to send to `model`, see `ContextManager.fit`"""
+    context = get_context_manager()
+    messages = context.fit(
+        messages, model, summarize=lambda m: summarize_messages(m, model)
+    )
+    if context.dropped:
+        printmd(
+            f"**[Context]**: {context.dropped} earlier messages left out to fit the context window of `{model}`"
+        )
+    return messages
+
+
+def pick_candidate(candidates: List[str], keep: str) -> Optional[int]:
+    """
+    Ask which of `candidates` to keep, return its index or None to `keep` what
+    there is. Empty candidates cannot be picked.
+    """
+    for _ in range(3):
+        try:
+            choice = input(
+                f"Pick a candidate to keep [1-{len(candidates)}], leave blank to {keep}: "
+            ).strip()
+        except (KeyboardInterrupt, EOFError):
+            print()
+            return None
+        if not choice:
+            return None
+        if choice.isdigit() and 1 <= int(choice) <= len(candidates):
+            if candidates[int(choice) - 1]:
+                return int(choice) - 1
+        print("Invalid candidate, please try again")
+    return None
+
+
+def generate_candidates(
+    messages: List[Dict[str, str]],
+    count: int,
+    use_streaming: bool,
+    model: str = DEFAULT_MODEL,
+) -> Iterator[Tuple[int, str]]:
+    """
+    Generate `count` alternative replies to `messages` with a single request
+    (the `n` parameter of the API), yielding `(candidate, chunk)` pairs as they
+    arrive. Failed requests are retried as configured, but never after part of
+    a reply was received.
+    """
+    import openai  # deferred until the first request, see `chatgpt_cli.client`
+
+    messages = fit_request(messages, model)
+    policy = get_retry_policy()
+    attempt = 0
+    while True:
+        attempt += 1
+        received = False
+        reserved = wait_for_rate_limit(messages, model, replies=count)
+        try:
+            with console.status(f"[bold green]Preparing {count} responses..."):
+                chunks = get_engine().chat(
+                    model=model, messages=messages, stream=use_streaming, n=count
+                )
+                first = next(chunks, None)
+            if first is None:
+                settle_rate_limit(model, reserved, 0)
+                return
+            if not use_streaming:
+                settle_rate_limit(
+                    model, reserved, first.get("usage", {}).get("total_tokens")
+                )
+                for choice in first["choices"]:
+                    yield choice["index"], choice["message"]["content"].strip()
+                return
+            replies = [""] * count
+            for chunk in itertools.chain([first], chunks):
+                for choice in chunk["choices"]:
+                    if "content" in choice["delta"]:
+                        received = True
+                        replies[choice["index"]] += choice["delta"]["content"]
+                        yield choice["index"], choice["delta"]["content"]
+            used = reserved - get_reply_tokens() * count
+            used += sum(count_text_tokens(reply, model) for reply in replies)
+            settle_rate_limit(model, reserved, used)
+            return
+        except openai.error.OpenAIError as err:
+            if not received:
+                settle_rate_limit(model, reserved, 0)
+            delay = None if received else policy.delay(err, attempt)
+            if delay is not None:
+                status = f"[bold yellow]{type(err).__name__}, retrying in {delay:.1f}s (attempt {attempt + 1}/{policy.max_attempts(err)})..."
+                with console.status(status):
+                    policy.wait(err, delay)
+                continue
+            print(err)
+            printpnl(error_hint(err))
+            return
+
+
+def generate_comparison(
+    messages: List[Dict[str, str]],
+    stats: List[ModelStats],
+    use_streaming: bool,
+) -> Iterator[Tuple[int, str]]:
+    """
+    Send `messages` to the model of each of `stats` at once, yielding
+    `(model, chunk)` pairs as the replies arrive, and record the latency of
+    every model in its `stats`. Failed requests are not retried, so that each
+    model is timed on a single request, and their error is yielded instead.
+    """
+    requests = []
+    reserved = []
+    for s in stats:
+        fitted = fit_request(messages, s.model)
+        reserved.append(wait_for_rate_limit(fitted, s.model))
+        requests.append({"model": s.model, "messages": fitted, "stream": use_streaming})
+    replies = [""] * len(stats)
+    start = time.monotonic()
+    for s in stats:
+        s.start = start
+        s.streamed = use_streaming
+    items = get_engine().chat_many(requests)
+    try:
+        with console.status(f"[bold green]Waiting for {len(stats)} models..."):
+            first = next(items, None)
+        if first is None:
+            return
+        for i, item in itertools.chain([first], items):
+            now = time.monotonic()
+            s = stats[i]
+            if isinstance(item, Exception):
+                s.error = f"{type(item).__name__}: {item}"
+                yield i, f"**[Error]**: {item}"
+                continue
+            if use_streaming:
+                chunk = item["choices"][0]["delta"].get("content")
+                if not chunk:
+                    continue
+            else:
+                chunk = item["choices"][0]["message"]["content"].strip()
+                s.tokens = item.get("usage", {}).get("completion_tokens") or 0
+            if s.first is None:
+                s.first = now
+            s.end = now
+            replies[i] += chunk
+            yield i, chunk
+    finally:
+        items.close()
+        for i, s in enumerate(stats):
+            if use_streaming or not s.tokens:
+                s.tokens = count_text_tokens(replies[i], s.model)
+            used = reserved[i] - get_reply_tokens() + s.tokens if replies[i] else 0
+            settle_rate_limit(s.model, reserved[i], used)
+
+
+def generate_response(
+    messages: List[Dict[str, str]],
+    use_streaming: bool,
+    use_cache: bool = True,
+    digest: str = None,
+    model: str = DEFAULT_MODEL,
+) -> str:
+    """
+    Generate a reply to `messages`, yielding it in chunks when streaming. With
+    the response cache enabled, an identical earlier request is answered from
+    the cache unless `use_cache` is False (e.g. for `!regen`). `digest` is the
+    rolling hash of `messages` if the caller keeps one (see `PrefixChain`).
+    """
+    import openai  # deferred until the first request, see `chatgpt_cli.client`
+
+    params = {}  # sampling parameters sent with the request, e.g. temperature
+    context = get_context_manager()
+    messages = fit_request(messages, model)
+    if context.dropped:
+        digest = None  # the messages sent are not the ones hashed
+    cache = get_response_cache()
+    key = cache_key(model, params, messages, digest) if cache is not None else None
+    if cache is not None and use_cache:
+        content = cache.get(key)
+        if content is not None:
+            printmd("**[Cache]**: Reply loaded from the response cache")
+            yield content
+            return
+
+    policy = get_retry_policy()
+    attempt = 0
+    while True:
+        attempt += 1
+        received = False
+        reserved = wait_for_rate_limit(messages, model)
+        try:
+            with console.status("[bold green]Preparing response..."):
+                chunks = get_engine().chat(
+                    model=model,
+                    messages=messages,
+                    stream=use_streaming,
+                    **params,
+                )
+                # wait for the first chunk (or the full response) under the spinner
+                first = next(chunks, None)
+            if first is None:
+                settle_rate_limit(model, reserved, 0)
+                return
+
+            if use_streaming:
+                # streamed replies carry no usage, so the reply is counted here
+                reply = []
+                for chunk in itertools.chain([first], chunks):
+                    if "content" not in chunk["choices"][0]["delta"]:
+                        continue
+                    received = True
+                    reply.append(chunk["choices"][0]["delta"]["content"])
+                    yield reply[-1]
+                content = "".join(reply)
+                used = reserved - get_reply_tokens() + count_text_tokens(content, model)
+                settle_rate_limit(model, reserved, used)
+            else:
+                used = first.get("usage", {}).get("total_tokens")
+                settle_rate_limit(model, reserved, used)
+                content = first["choices"][0]["message"]["content"].strip()
+                yield content
+            if cache is not None and content:
+                cache.put(key, model, content)
+            return
+
+        except openai.error.OpenAIError as err:
+            if not received:
+                settle_rate_limit(model, reserved, 0)
+            # a partially streamed reply has already been shown, so it cannot
+            # be retried transparently
+            delay = None if received else policy.delay(err, attempt)
+            if delay is not None:
+                status = f"[bold yellow]{type(err).__name__}, retrying in {delay:.1f}s (attempt {attempt + 1}/{policy.max_attempts(err)}, {policy.stats} so far)..."
+                with console.status(status):
+                    policy.wait(err, delay)
+                continue
+            print(err)
+            printpnl(error_hint(err))
+            if received or not policy.retryable(err) or not policy.interactive:
+                return
+            user_message = input("Do you want to retry now? (y/n): ")
+            if user_message.strip().lower() != "y":
+                return
+            attempt = 0
+        except Exception as e:
+            print(e)
+            printpnl(UNKNOWN_ERROR_HINT)
+            return
+
+
 class Conversation:
     def __init__(
-        self, default_prompt: List[Dict[str, str]], use_streaming: bool
+        self,
+        default_prompt: List[Dict[str, str]],
+        use_streaming: bool,
+        model: str = DEFAULT_MODEL,
     ) -> None:
-        self.messages = list(default_prompt)
-        self.default_prompt = list(default_prompt)
+        # messages are copied, the settings they come from are read-only
+        self.default_prompt = [dict(m) for m in default_prompt]
+        # the checked out branch holds the messages, the other branches share
+        # their first messages with the branch they were forked from
+        self.tree = BranchTree([dict(m) for m in self.default_prompt])
         self.use_streaming = use_streaming
+        # model of new conversations, `!model` switches the model of this one
+        self.default_model = model
         self.filepath = ""
         self.modified = False
+        # journal records not saved yet, a full snapshot is written instead
+        # while `snapshot` is set (e.g. before the first save)
+        self.pending: List[Dict] = []
+        self.snapshot = True
+        # rolling hashes and token totals, truncated at every changed message
+        self.prefix = PrefixChain(model)
         self.template_object = Template()
 
     def __len__(self) -> int:
         return len(self.messages)
 
+    @property
+    def messages(self) -> MutableSequence:
+        """Messages of the checked out branch"""
+        return self.tree.messages
+
+    @messages.setter
+    def messages(self, messages: MutableSequence) -> None:
+        self.tree.messages = messages
+
+    @property
+    def branch(self) -> str:
+        return self.tree.current
+
+    @property
+    def model(self) -> str:
+        """Model of the conversation, saved with it in journals"""
+        return self.tree.model or self.default_model
+
     def __add_message(self, message: Dict[str, str]) -> None:
         self.messages.append(message)
+        self.count_tokens(message)
+        self.__record({"op": "append", "message": dict(message)})
+        self.modified = True
+
+    def __record(self, record: Dict) -> None:
+        """Remember a change for the next append to the journal"""
+        if not self.snapshot:
+            self.pending.append(record)
+
+    def __record_set(self, index: int) -> None:
+        index = index % len(self.messages)
+        self.prefix.truncate(index)
+        self.tree.changed(index)
+        self.__record(
+            {"op": "set", "index": index, "message": dict(self.messages[index])}
+        )
+
+    def __reset_journal(self) -> None:
+        """The messages were replaced as a whole, write a snapshot next time"""
+        self.pending = []
+        self.snapshot = True
+        self.prefix = PrefixChain(self.model)
+
+    def __replace(self, index: int, message: Dict) -> None:
+        """
+        Replace message `index` by `message`, a changed copy of it. Messages are
+        never changed in place, as other branches may share them.
+        """
+        self.messages[index] = message
+        self.count_tokens(message)
+        self.__record_set(index)
         self.modified = True
 
+    def count_tokens(self, message: Dict[str, str]) -> int:
+        """
+        Tokens of `message`. The count is stored in the message (and saved with
+        it) along with its encoding, so it is only computed again after its
+        content changes or for a model with another encoding.
+        """
+        if message.get("tokens") is None:
+            message["tokens"] = count_message_tokens(message, self.model)
+            message["encoding"] = encoding_name(self.model)
+        return count_message_tokens(message, self.model)
+
+    def token_count(self) -> int:
+        """Total tokens of the conversation"""
+        return self.prefix.tokens(self.messages)
+
+    def digest(self, count: int = None) -> str:
+        """Rolling hash of the first `count` messages (all by default)"""
+        messages = self.messages if count is None else self.messages[:count]
+        return self.prefix.digest(messages)
+
+    def show_token_count(self) -> None:
+        printmd(
+            f"**{len(self.messages)} messages, {self.token_count()} tokens in total.**"
+        )
+
     def add_user_message(self, content: str) -> None:
         self.__add_message({"role": "user", "content": content})
 
@@ -94,12 +449,53 @@ class Conversation:
 
     def edit_system_message(self, content: str) -> None:
         if self.messages[0]["role"] == "system":
-            self.messages[0]["content"] = content
-            self.modified = True
+            message = dict(self.messages[0], content=content)
+            message.pop("tokens", None)
+            self.__replace(0, message)
         else:
             raise Exception("The first message is not a system message.")
 
+    def __materialize(self) -> None:
+        """Decode all messages of a lazily loaded journal before it is written"""
+        if isinstance(self.messages, LazyMessages):
+            self.messages = self.messages.materialize()
+
+    def autosave(self) -> None:
+        """Hand the conversation over to the background writer, if enabled"""
+        writer = get_autosave_writer()
+        if writer is None or not self.modified:
+            return
+        if writer.error is not None:
+            printmd(f"**[Autosave Error]**: {writer.error}")
+            writer.error = None
+        if not self.filepath:
+            t = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+            self.filepath = get_data_path(f"conversation_{t}")
+        self.__materialize()
+        records = None if self.snapshot else self.pending
+        # the writer gets its own list of the checked out branch, the other
+        # branches and the messages are never changed in place
+        messages = list(self.messages)
+        writer.submit(self.filepath, messages, records, self.tree.copy(messages))
+        self.pending = []
+        self.snapshot = False
+        self.modified = False
+
     def save(self, enable_prompt: bool) -> None:
+        writer = get_autosave_writer()
+        if writer is not None:
+            if enable_prompt:
+                # nothing to ask, the conversation is saved in the background
+                self.autosave()
+                return
+            # wait for pending writes before saving to the same file
+            writer.flush()
+            if self.filepath and writer.take_failed(self.filepath):
+                # the file may lack the records of the failed write
+                self.pending = []
+                self.snapshot = True
+                self.modified = True
+
         if enable_prompt and self.modified:
             user_input = input("Save conversation? [y/n]: ").strip()
             if user_input.lower() != "y":
@@ -111,13 +507,19 @@ class Conversation:
                 filename = os.path.basename(self.filepath)
             else:
                 t = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-                tmp = f"conversation_{t}.json"
+                tmp = f"conversation_{t}{get_storage_extension()}"
                 filename = input(f"Enter filename to save to [{tmp}]: ").strip()
                 if not filename:
                     filename = tmp
+                if not is_data_file(filename):
+                    filename += get_storage_extension()
                 self.filepath = os.path.join(get_data_dir(), filename)
             printmd(f"**Conversation save to [{filename}].**")
-            save_data(self.messages, filename)
+            self.__materialize()
+            records = None if self.snapshot else self.pending
+            save_data(self.messages, filename, records, self.tree)
+            self.pending = []
+            self.snapshot = False
             self.modified = False
         else:
             printmd("**Conversation not modified. Nothing to save.**")
@@ -127,18 +529,45 @@ class Conversation:
             user_input = input("Save conversation? [y/n]: ").strip()
             if user_input.lower() == "y":
                 self.save(enable_prompt=False)
-        self.messages = list(self.default_prompt)
-        self.filepath = load_data(self.messages)
+        writer = get_autosave_writer()
+        if writer is not None:
+            writer.flush()
+        self.filepath, tree = load_data()
+        if self.filepath:
+            # large journals are decoded as their messages are needed
+            self.tree = tree
+        else:
+            self.tree = BranchTree([dict(m) for m in self.default_prompt])
+        self.__reset_journal()
+        self.snapshot = not self.filepath
         self.modified = False
         printpnl("### Conversation loaded.", "ChatGPT CLI", "green", 120)
 
+    def compact(self) -> None:
+        """Convert saved conversations to compressed journals"""
+        writer = get_autosave_writer()
+        if writer is not None:
+            writer.flush()
+        converted = compact_data_directory()
+        if self.filepath in converted:
+            self.filepath = converted[self.filepath]
+
+    def search(self, query: str) -> None:
+        """Search all saved conversations"""
+        writer = get_autosave_writer()
+        if writer is not None:
+            # the index is refreshed from the files, which must be complete
+            writer.flush()
+        search_data(query)
+
     def reset(self) -> None:
         if self.modified:
             user_input = input("Save conversation? [y/n]: ").strip()
             if user_input.lower() == "y":
                 self.save(enable_prompt=False)
         self.filepath = ""
-        self.messages = list(self.default_prompt)
+        self.tree = BranchTree([dict(m) for m in self.default_prompt])
+        self.__reset_journal()
         self.modified = False
         printpnl("### Conversation reset.", "ChatGPT CLI", "green", 120)
 
@@ -152,12 +581,17 @@ class Conversation:
         # Resend last prompt
         last_message = self.messages[-1]
         if last_message["role"] == "user":
-            assistant_message_gen = generate_response(self.messages, self.use_streaming)
+            assistant_message_gen = generate_response(
+                self.messages,
+                self.use_streaming,
+                digest=self.digest(),
+                model=self.model,
+            )
 
             if self.use_streaming == True:
                 assistant_message = assistant_stream(assistant_message_gen)
             else:
-                assistant_message = list(assistant_message_gen)[0]
+                assistant_message = "".join(assistant_message_gen)
 
             if not assistant_message:
                 printmd("**Last response is empty. Resend failed.**")
@@ -172,28 +606,41 @@ class Conversation:
         else:
             printmd("**Last message is assistant message. Nothing to resend.**")
 
-    def regen(self) -> None:
-        self.regenerate_last_response()
+    def regen(self, count: int = 1) -> None:
+        if count > 1:
+            self.regenerate_candidates(count)
+        else:
+            self.regenerate_last_response()
 
-    def regenerate_last_response(self) -> None:
-        """Regenerate last response"""
+    def __can_regenerate(self) -> bool:
         if len(self.messages) < 2:
             printmd("**No previous response to regenerate.**")
-            return
-        # Regenerate last response
-        last_message = self.messages[-1]
-        if last_message["role"] == "user":
+            return False
+        if self.messages[-1]["role"] == "user":
             printmd(
                 "**Last message is user message. Nothing to regenerate. You may want to use `!resend` instead.**"
             )
+            return False
+        return True
+
+    def regenerate_last_response(self) -> None:
+        """Regenerate last response"""
+        if not self.__can_regenerate():
             return
 
-        content_gen = generate_response(self.messages[:-1], self.use_streaming)
+        # a fresh reply is wanted, never the cached one
+        content_gen = generate_response(
+            self.messages[:-1],
+            self.use_streaming,
+            use_cache=False,
+            digest=self.digest(len(self.messages) - 1),
+            model=self.model,
+        )
 
         if self.use_streaming == True:
             content = assistant_stream(content_gen)
         else:
-            content = list(content_gen)[0]
+            content = "".join(content_gen)
 
         if not content:
             printmd("**Last response is empty. Content not regenerated.**")
@@ -203,10 +650,137 @@ class Conversation:
             assistant_output(self.messages[-1]["content"])
         printmd("**Last response regenerated.**")
 
+    def regenerate_candidates(self, count: int) -> None:
+        """
+        Generate `count` new responses at once and let the user pick one. The
+        responses not picked are kept in branches, see `!branches`.
+        """
+        if not self.__can_regenerate():
+            return
+        gen = generate_candidates(
+            self.messages[:-1], count, self.use_streaming, self.model
+        )
+        titles = [f"Candidate {i + 1}" for i in range(count)]
+        if self.use_streaming:
+            candidates = split_stream(gen, titles)
+        else:
+            candidates = [""] * count
+            for i, content in gen:
+                candidates[i] = content
+            if any(candidates):
+                print(split_view(candidates, titles))
+        if not any(candidates):
+            printmd("**No responses generated. Content not regenerated.**")
+            return
+
+        selected = pick_candidate(candidates, "keep the current response")
+
+        current = self.messages[-1]["content"]
+        content = current if selected is None else candidates[selected]
+        others = [current] if selected is not None else []
+        others.extend(c for i, c in enumerate(candidates) if c and i != selected)
+        # the same text is kept once, and never next to itself
+        others = [
+            c for i, c in enumerate(others) if c != content and c not in others[:i]
+        ]
+        names = [self.__keep_alternative(c) for c in others]
+        if selected is not None:
+            self.__fill_content(-1, content)
+        kept = ", ".join(f"`{name}`" for name in names) or "none"
+        if selected is None:
+            printmd(f"**Current response kept, other responses in branches: {kept}.**")
+        else:
+            printmd(
+                f"**Candidate {selected + 1} picked, other responses in branches: {kept}.**"
+            )
+
+    def __keep_alternative(self, content: str) -> str:
+        """
+        Keep `content` as another last response, in a new branch forked before
+        the last message, and return the name of the branch
+        """
+        names = self.tree.names()
+        name = next(
+            f"regen-{i}" for i in itertools.count(1) if f"regen-{i}" not in names
+        )
+        if not names[1:]:
+            self.__warn_branches()
+        self.__materialize()
+        message = dict(self.messages[-1], content=content)
+        message.pop("tokens", None)
+        self.count_tokens(message)
+        current = self.branch
+        # the checked out branch is rebuilt from the same messages, so the
+        # prefix chain still holds
+        for record in [
+            {"op": "branch", "name": name, "from": current, "at": len(self) - 1},
+            {"op": "checkout", "name": name},
+            {"op": "append", "message": message},
+            {"op": "checkout", "name": current},
+        ]:
+            self.tree.apply(record)
+            self.__record(record)
+        self.modified = True
+        return name
+
+    def __warn_branches(self) -> None:
+        if not is_journal(self.filepath or get_storage_extension()):
+            printmd(
+                "**[Warning]**: Only the checked out branch is saved, use the `jsonl` or `jsonl.gz` storage format to keep all branches"
+            )
+
+    def set_model(self, model: str) -> None:
+        record = {"op": "model", "model": model}
+        self.tree.apply(record)
+        self.__record(record)
+        # stored token counts may not hold for the encoding of `model`
+        self.prefix = PrefixChain(model)
+        self.modified = True
+        printmd(f"**Model switched to `{model}` for this conversation.**")
+
+    def compare(self, models: List[str]) -> None:
+        """
+        Send the last prompt to each of `models` at once, show their replies
+        side by side with their latency, and let the user keep one of them.
+        """
+        messages = self.messages
+        replace = len(messages) > 1 and messages[-1]["role"] == "assistant"
+        if replace:
+            messages = messages[:-1]
+        if not messages or messages[-1]["role"] != "user":
+            printmd("**No prompt to compare the models on.**")
+            return
+        stats = [ModelStats(model) for model in models]
+        gen = generate_comparison(messages, stats, self.use_streaming)
+        if self.use_streaming:
+            texts = split_stream(gen, models)
+        else:
+            texts = [""] * len(models)
+            for i, chunk in gen:
+                texts[i] += chunk
+            if any(texts):
+                print(split_view(texts, models))
+        show_stats(stats)
+        log_stats(stats)
+        replies = [t if s.error is None else "" for t, s in zip(texts, stats)]
+        if not any(replies):
+            printmd("**No responses generated.**")
+            return
+        keep = "keep the current response" if replace else "keep none of them"
+        selected = pick_candidate(replies, keep)
+        if selected is None:
+            return
+        if replace:
+            self.__fill_content(-1, replies[selected])
+        else:
+            self.add_assistant_message(replies[selected])
+        printmd(f"**Response of `{models[selected]}` kept.**")
+
     def __fill_content(self, index: int, content: str) -> None:
         """Fill content"""
-        self.messages[index]["content"] = content
-        self.modified = True
+        message = dict(self.messages[index], content=content)
+        message.pop("tokens", None)
+        self.__replace(index, message)
 
     def __edit_message(self, index: int, prompt=True) -> None:
         """Edit message"""
@@ -221,17 +795,31 @@ class Conversation:
         else:
             printmd("**Message not edited.**")
 
-    def show_history(self, index=False, panel=True):
-        """Show conversation history"""
+    def show_history(self, index=False, panel=True, start=0, stop=None):
+        """Show conversation history, messages `start` to `stop` if given"""
         if panel:
             printpnl("### Messages History", "ChatGPT CLI", "green")
-        if index:
-            for i in range(len(self.messages)):
+        stop = len(self.messages) if stop is None else min(stop, len(self.messages))
+        if start > 0:
+            printmd(
+                f"**[{start} earlier messages not shown, `!show` or `!show range a-b` to see them]**"
+            )
+        for i in range(start, stop):
+            if index:
                 printpnl(f"### Message {i}", "Messages History", "green")
-                show_message(self.messages[i])
-        else:
-            for message in self.messages:
-                show_message(message)
+            show_message(self.messages[i])
+        if stop < len(self.messages):
+            printmd(f"**[{len(self.messages) - stop} later messages not shown]**")
+
+    def history_window(self) -> int:
+        """Index of the first of the last messages that fit on the screen"""
+        height = console.height
+        start = len(self.messages)
+        # only the messages in the window are decoded and measured
+        while start > 0 and height > 0:
+            start -= 1
+            height -= message_height(self.messages[start])
+        return start
 
     def edit_messages(self) -> None:
         """Edit messages"""
@@ -292,6 +880,9 @@ class Conversation:
                 confirm = input("Drop this message? [y/n]: ").strip()
                 if confirm.lower() == "y":
                     self.messages.pop(i)
+                    self.prefix.truncate(i)
+                    self.tree.changed(i)
+                    self.__record({"op": "drop", "index": i})
                     self.modified = True
                     printmd("**Message dropped.**")
                 else:
@@ -300,22 +891,117 @@ class Conversation:
         else:
             printmd("**No message selected. Dropping cancelled.**")
 
-    def switch_template(self, id):
-        """Switch template"""
-        self.template_object.id = id
-        roles = [msg["role"] for msg in self.template_object.templates[id]["prompts"]]
+    def pin_messages(self) -> None:
+        """Pin or unpin messages, pinned messages are always kept in the context"""
+        if len(self.messages) == 0:
+            printmd("**No message to pin.**")
+            return
+        printpnl("### Messages History", "Pinning Messages", "yellow")
+        for i, msg in enumerate(self.messages):
+            pinned = " (pinned)" if msg.get("pinned") else ""
+            printpnl(f"### Message {i}{pinned}", "Pinning Messages", "yellow")
+            show_message(msg)
+        index = (
+            input(
+                "Enter index of messages to pin or unpin, separate with comma (e.g. 0,1,2), leave blank to cancel: "
+            )
+            .strip()
+            .strip(",")
+        )
+        if not index:
+            printmd("**Pinning cancelled.**")
+            return
+        try:
+            index = [int(i.strip()) for i in index.split(",")]
+            for i in index:
+                if i >= len(self.messages):
+                    raise ValueError
+        except ValueError:
+            printmd("**Invalid index. Pinning cancelled.**")
+            return
+        for i in index:
+            message = dict(self.messages[i])
+            if message.pop("pinned", False):
+                printmd(f"**Message {i} unpinned.**")
+            else:
+                message["pinned"] = True
+                printmd(f"**Message {i} pinned.**")
+            self.__replace(i, message)
+
+    def create_branch(self, name: str, count: int = None) -> None:
+        """
+        Fork branch `name` with the first `count` messages (all by default) of
+        the checked out branch, and check it out.
+        """
+        if name in self.tree.names():
+            printmd(f"**Branch `{name}` already exists.**")
+            return
+        count = len(self.messages) if count is None else count
+        if not 0 <= count <= len(self.messages):
+            printmd(
+                f"**Invalid number of messages, branch `{self.branch}` has {len(self.messages)}.**"
+            )
+            return
+        self.__warn_branches()
+        self.__materialize()
+        self.__record({"op": "branch", "name": name, "from": self.branch, "at": count})
+        # the new branch shares the messages, nothing is copied but the list
+        self.tree.fork(name, self.branch, count)
+        self.tree.checkout(name)
+        self.prefix.truncate(count)
+        self.__record({"op": "checkout", "name": name})
+        self.modified = True
+        printmd(f"**Branch `{name}` created with {count} messages.**")
+
+    def checkout(self, name: str) -> None:
+        """Check out branch `name`"""
+        if name == self.branch:
+            printmd(f"**Already on branch `{name}`.**")
+            return
+        if name not in self.tree.branches:
+            printmd(f"**Branch `{name}` not found, see `!branches`.**")
+            return
+        self.__materialize()
+        shared = shared_prefix(self.messages, self.tree.get(name))
+        self.tree.checkout(name)
+        self.prefix.truncate(shared)
+        self.__record({"op": "checkout", "name": name})
+        self.modified = True
+        printmd(f"**Switched to branch `{name}`.**")
+
+    def show_branches(self) -> None:
+        """List the branches, with the messages each shares with the current one"""
+        from rich.table import Table
+
+        table = Table("", "Branch", "Messages", "Shared", "Last message")
+        for name in self.tree.names():
+            messages = self.tree.get(name)
+            current = name == self.branch
+            last = " ".join(messages[-1]["content"].split()) if messages else ""
+            table.add_row(
+                "*" if current else "",
+                escape(name),
+                str(len(messages)),
+                "" if current else str(shared_prefix(self.messages, messages)),
+                escape(last[:60] + ("..." if len(last) > 60 else "")),
+            )
+        print(table)
+
+    def switch_template(self, template: Dict) -> None:
+        """Switch to `template`, as found in the template registry"""
+        self.template_object.name = template["name"]
+        roles = [msg["role"] for msg in template["prompts"]]
         if "system" in roles:
-            self.default_prompt = list(self.template_object.templates[id]["prompts"])
+            self.default_prompt = [dict(m) for m in template["prompts"]]
         else:
-            self.default_prompt.extend(
-                list(self.template_object.templates[id]["prompts"])
-            )
+            self.default_prompt.extend(dict(m) for m in template["prompts"])
         printmd(f"**Template switched to {self.template_object.get_name()}.**")
 
 
 """
 Features (under development):
 - `!tmpl`: select a template to use
+- `!tmpl <name|alias>`: switch to a template directly
 - `!tmpl show`: show all templates with complete information
 - `!tmpl create`: create a new template
 - `!tmpl edit`: edit an existing template
@@ -325,46 +1011,52 @@ Features (under development):
 
 class Template:
     def __init__(self) -> None:
-        self.templates = self.__load_templates()
-        self.id = None
+        self.name = None
 
     def get_name(self) -> str:
-        return self.templates[self.id]["name"]
+        return self.name
 
-    def __load_templates(self) -> List[Dict]:
-        return load_templates()
+    @property
+    def templates(self) -> TemplateRegistry:
+        # looked up on every use, so changes to `patch.yaml` are picked up
+        return get_template_registry()
 
-    def __parse_command(self, cmd: str) -> List[str]:
+    def __parse_command(self, cmd: str) -> str:
+        """The arguments of a `!tmpl` command, as typed"""
         cmd = cmd.strip()
         if cmd.startswith("!tmpl"):
-            cmd = cmd[5:].strip()
-        else:
-            raise ValueError(f"Invalid command {cmd} for template")
-        return cmd.split()
+            return cmd[5:].strip()
+        raise ValueError(f"Invalid command {cmd} for template")
 
     def execute_command(self, cmd: str, conv: Conversation):
-        cmd = self.__parse_command(cmd)
-        if not cmd or cmd[0] == "load":
+        args = self.__parse_command(cmd)
+        # a template named or aliased like a subcommand is switched to
+        template = self.templates.get(args) if args else None
+        subcommand = args.split()[0] if args else ""
+        if template is not None:
+            self.__apply(template, conv)
+        elif not args or subcommand == "load":
             self.load(conv=conv)
-        elif cmd[0] == "show":
+        elif subcommand == "show":
             self.show()
-        elif cmd[0] == "create":
+        elif subcommand == "create":
             self.create()
-        elif cmd[0] == "edit":
+        elif subcommand == "edit":
             self.edit()
-        elif cmd[0] == "drop":
+        elif subcommand == "drop":
             self.drop()
         else:
-            printmd("**[Error]: Invalid command.**")
+            self.switch(args, conv=conv)
 
     def show(self, only_name: bool = False):
         print("Config Directory:", get_config_dir())
         print(f"Templates (in {get_patch_path()}):\n")
+        templates = self.templates
         if only_name:
-            for i, t in enumerate(self.templates):
+            for i, t in enumerate(templates):
                 print(f"{i + 1}. {t['name']} ({t['alias']})")
             return
-        for i, t in enumerate(self.templates):
+        for i, t in enumerate(templates):
             print(f"{i + 1}. {t['name']} ({t['alias']})")
             print(f"    Description: {t['description']}")
             print(f"    Messages:")
@@ -384,22 +1076,40 @@ class Template:
     def drop(self):
         update_patch(drop_template)
 
+    def switch(self, key: str, conv: Conversation) -> bool:
+        """Switch `conv` to the template named or aliased `key`"""
+        template = self.templates.get(key)
+        if template is None:
+            printmd(f"**[Error]**: Template `{key}` not found")
+            return False
+        self.__apply(template, conv)
+        return True
+
+    def __apply(self, template: Dict, conv: Conversation) -> None:
+        self.name = template["name"]
+        conv.switch_template(template)
+        conv.reset()
+        conv.show_history()
+
     def load(self, conv: Conversation):
         self.show(only_name=True)
         for i in range(3):
             try:
-                selected_id = input(
-                    "\nPlease select a template (leave blank to skip): "
+                selected = input(
+                    "\nPlease select a template by number, name or alias (leave blank to skip): "
                 ).strip()
-                if not selected_id:
+                if not selected:
                     printmd("**No template selected.**")
                     return
-                self.id = int(selected_id) - 1
-                if self.id < 0 or self.id >= len(self.templates):
+                templates = self.templates
+                if not selected.isdigit():
+                    if self.switch(selected, conv):
+                        return
+                    continue
+                index = int(selected) - 1
+                if index < 0 or index >= len(templates):
                     raise ValueError
-                conv.switch_template(self.id)
-                conv.reset()
-                conv.show_history()
+                self.__apply(templates[index], conv)
                 return
             except ValueError:
                 print("Invalid template id, please try again")
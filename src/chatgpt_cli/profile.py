@@ -0,0 +1,74 @@
+"""
+Startup profiling: `chatgpt-cli --profile-startup`.
+
+The CLI is started once more in a child interpreter running with
+`-X importtime`, which exits right before the first `User:` prompt. The time
+it took and the import time of every top-level package are then printed.
+"""
+import os
+import sys
+import time
+from typing import Dict, Iterable, List, Tuple
+
+from utils.io import print, printmd
+
+# set for the child process, which then exits instead of prompting
+EXIT_BEFORE_PROMPT_ENV = "CHATGPT_CLI_EXIT_BEFORE_PROMPT"
+
+
+def exit_before_prompt() -> bool:
+    return bool(os.environ.get(EXIT_BEFORE_PROMPT_ENV))
+
+
+def parse_importtime(lines: Iterable[str]) -> Dict[str, int]:
+    """Self import time in microseconds per top-level package"""
+    packages: Dict[str, int] = {}
+    for line in lines:
+        if not line.startswith("import time:"):
+            continue
+        fields = line[len("import time:") :].split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue  # the header line
+        package = fields[2].strip().split(".")[0]
+        packages[package] = packages.get(package, 0) + int(fields[0])
+    return packages
+
+
+def profile_startup(top: int = 15) -> None:
+    import subprocess
+
+    env = dict(os.environ, **{EXIT_BEFORE_PROMPT_ENV: "1"})
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "chatgpt_cli.chat"],
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    elapsed = (time.perf_counter() - start) * 1000
+    lines = process.stderr.splitlines()
+    if process.returncode != 0:
+        errors = [line for line in lines if not line.startswith("import time:")]
+        printmd(f"**[Error]**: Startup failed with exit code {process.returncode}")
+        print("\n".join(errors[-20:]))
+        exit(1)
+
+    from rich.table import Table
+
+    packages = parse_importtime(lines)
+    imports = sum(packages.values()) / 1000
+    rows: List[Tuple[str, int]] = sorted(
+        packages.items(), key=lambda item: item[1], reverse=True
+    )
+    printmd(
+        f"**Startup**: {elapsed:.0f} ms to the first prompt, {imports:.0f} ms of it importing modules"
+    )
+    table = Table("Package", "Import time", "Share")
+    for package, us in rows[:top]:
+        table.add_row(package, f"{us / 1000:.1f} ms", f"{us / 10 / elapsed:.0f}%")
+    others = sum(us for _, us in rows[top:])
+    if others:
+        table.add_row(f"{len(rows) - top} others", f"{others / 1000:.1f} ms", "")
+    print(table)
@@ -0,0 +1,235 @@
+"""
+Client-side rate limiting.
+
+A `RateLimiter` keeps one token bucket for requests and one for tokens, both
+refilled continuously at their per-minute rate. Every request path reserves
+capacity from the limiter of its model before hitting the API and waits as
+long as it is told to, so bursts are spread out instead of failing with
+`RateLimitError`. With `shared: true`, the buckets live in a lock file in the
+config directory, so all CLI processes on a host draw from the same budget.
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, budgets are per process there
+    fcntl = None
+
+from utils.settings import get_config_dir
+
+DEFAULT_RATE_LIMIT_OPTIONS = {
+    "requests_per_minute": None,  # request budget per model, unlimited if not set
+    "tokens_per_minute": None,  # token budget per model, unlimited if not set
+    "reply_tokens": 256,  # tokens reserved for each reply until it is known
+    "shared": False,  # share the budgets between processes through a lock file
+    "models": {},  # budgets of specific models, overriding the ones above
+}
+
+LOCK_FILENAME = "ratelimit.json"
+
+_options = dict(DEFAULT_RATE_LIMIT_OPTIONS)
+_limiters: Dict[str, "RateLimiter"] = {}
+
+
+class TokenBucket:
+    def __init__(
+        self, per_minute: float, capacity: float = None, now: float = None
+    ) -> None:
+        self.rate = float(per_minute) / 60.0
+        self.capacity = float(capacity if capacity is not None else per_minute)
+        self.level = self.capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def __refill(self, now: float) -> None:
+        elapsed = max(now - self.updated, 0.0)
+        self.level = min(self.capacity, self.level + elapsed * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float, now: float = None) -> float:
+        """
+        Take `amount` from the bucket and return the seconds to wait until it
+        is actually available. The level goes negative while waiting, so later
+        reservations queue up behind this one.
+        """
+        self.__refill(time.monotonic() if now is None else now)
+        self.level -= amount
+        if self.level >= 0:
+            return 0.0
+        return -self.level / self.rate
+
+    def refund(self, amount: float) -> None:
+        """Give back capacity that was reserved but not used"""
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+    ) -> None:
+        now = self.clock()
+        self.requests = (
+            TokenBucket(requests_per_minute, now=now) if requests_per_minute else None
+        )
+        self.tokens = (
+            TokenBucket(tokens_per_minute, now=now) if tokens_per_minute else None
+        )
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def clock() -> float:
+        return time.monotonic()
+
+    @property
+    def limited(self) -> bool:
+        return self.requests is not None or self.tokens is not None
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Hold the buckets for a change"""
+        with self.lock:
+            yield
+
+    def reserve(self, tokens: int = 0) -> float:
+        """Reserve one request using `tokens`, return the seconds to wait"""
+        if not self.limited:
+            return 0.0
+        with self._locked():
+            now = self.clock()
+            delay = 0.0
+            if self.requests is not None:
+                delay = max(delay, self.requests.reserve(1, now))
+            if self.tokens is not None:
+                delay = max(delay, self.tokens.reserve(tokens, now))
+            return delay
+
+    def settle(self, reserved: int, used: Optional[int]) -> None:
+        """Correct a reservation of `reserved` tokens once `used` is known"""
+        if self.tokens is None or used is None:
+            return
+        with self._locked():
+            if used < reserved:
+                self.tokens.refund(reserved - used)
+            else:
+                self.tokens.reserve(used - reserved, self.clock())
+
+
+class SharedRateLimiter(RateLimiter):
+    """
+    A limiter whose buckets are stored in `path` under `key`. The file is
+    locked for every change, so processes sharing it share the budget.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        key: str,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+    ) -> None:
+        super().__init__(requests_per_minute, tokens_per_minute)
+        self.path = path
+        self.key = key
+
+    @staticmethod
+    def clock() -> float:
+        # monotonic clocks are not comparable between processes
+        return time.time()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self.lock, open(self.path, "a+") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read() or "{}")
+                except json.JSONDecodeError:
+                    state = {}
+                buckets = state.get(self.key, {})
+                for name in ["requests", "tokens"]:
+                    bucket = getattr(self, name)
+                    if bucket is not None and name in buckets:
+                        bucket.level, bucket.updated = buckets[name]
+                yield
+                state[self.key] = {
+                    name: [bucket.level, bucket.updated]
+                    for name, bucket in [
+                        ("requests", self.requests),
+                        ("tokens", self.tokens),
+                    ]
+                    if bucket is not None
+                }
+                f.seek(0)
+                f.truncate()
+                json.dump(state, f)
+                f.flush()
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def create_rate_limiter(
+    key: str,
+    requests_per_minute: Optional[float] = None,
+    tokens_per_minute: Optional[float] = None,
+) -> RateLimiter:
+    """A limiter for budget `key`, shared between processes if configured"""
+    if _options["shared"] and fcntl is not None:
+        path = os.path.join(get_config_dir(), LOCK_FILENAME)
+        return SharedRateLimiter(path, key, requests_per_minute, tokens_per_minute)
+    return RateLimiter(requests_per_minute, tokens_per_minute)
+
+
+def setup_rate_limit(options: Dict) -> None:
+    """Apply the `rate_limit` section of `config.yaml`"""
+    options = options or {}
+    for key in DEFAULT_RATE_LIMIT_OPTIONS:
+        if options.get(key) is not None:
+            _options[key] = options[key]
+    _limiters.clear()
+
+
+def get_reply_tokens() -> int:
+    return int(_options["reply_tokens"])
+
+
+def _budget(model: str) -> Dict:
+    budget = {
+        "requests_per_minute": _options["requests_per_minute"],
+        "tokens_per_minute": _options["tokens_per_minute"],
+    }
+    models = _options["models"] or {}
+    # e.g. `gpt-4-0314` falls back to `gpt-4`
+    prefixes = [m for m in models if model.startswith(m)]
+    if prefixes:
+        override = models[max(prefixes, key=len)] or {}
+        budget.update({k: v for k, v in override.items() if k in budget})
+    return budget
+
+
+def set_model_budget(
+    model: str,
+    requests_per_minute: Optional[float] = None,
+    tokens_per_minute: Optional[float] = None,
+) -> None:
+    """Override the budget of `model` for this process, e.g. from the command line"""
+    budget = _budget(model)
+    if requests_per_minute is not None:
+        budget["requests_per_minute"] = requests_per_minute
+    if tokens_per_minute is not None:
+        budget["tokens_per_minute"] = tokens_per_minute
+    _options["models"] = dict(_options["models"] or {}, **{model: budget})
+    _limiters.pop(model, None)
+
+
+def get_rate_limiter(model: str) -> RateLimiter:
+    """Return the limiter of `model`, used by every request to that model"""
+    if model not in _limiters:
+        _limiters[model] = create_rate_limiter(model, **_budget(model))
+    return _limiters[model]
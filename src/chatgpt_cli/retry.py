@@ -0,0 +1,169 @@
+"""
+Retry policy for failed API requests.
+
+The policy decides whether an error is worth retrying and how long to wait
+before the next attempt: exponential backoff with jitter, or the delay asked
+for by the server's `Retry-After` header, either capped at `max_delay`. Every
+option can be overridden per openai error class under `rules`.
+"""
+import random
+import time
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+
+DEFAULT_RETRY_OPTIONS = {
+    "max_attempts": 5,  # attempts per request, including the first one
+    "initial_delay": 1.0,  # seconds to wait before the first retry
+    "max_delay": 60.0,  # upper bound of any delay, `Retry-After` included
+    "multiplier": 2.0,  # growth factor of the backoff curve
+    "jitter": 0.5,  # fraction of each delay that is randomized
+    "respect_retry_after": True,  # prefer the server's `Retry-After` header
+    "interactive": True,  # ask before retrying again once attempts run out
+}
+
+# error classes retried by default, all others (e.g. `InvalidRequestError` or
+# `AuthenticationError`) fail right away unless a rule enables them
+RETRYABLE_ERRORS = [
+    "APIConnectionError",
+    "APIError",
+    "RateLimitError",
+    "ServiceUnavailableError",
+    "Timeout",
+    "TryAgain",
+]
+
+_options = dict(DEFAULT_RETRY_OPTIONS)
+_rules: Dict[str, Dict] = {}
+_policy = None
+
+
+class RetryStats:
+    def __init__(self) -> None:
+        self.retries = 0
+        self.waited = 0.0
+        self.errors: Dict[str, int] = {}
+
+    def record(self, err: Exception) -> None:
+        name = type(err).__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    def __str__(self) -> str:
+        errors = ", ".join(f"{count} {name}" for name, count in self.errors.items())
+        retries = (
+            f"{self.retries} retries ({errors})"
+            if errors
+            else f"{self.retries} retries"
+        )
+        return f"{retries}, {self.waited:.1f}s waited"
+
+
+class RetryPolicy:
+    def __init__(self, options: Dict = None, rules: Dict[str, Dict] = None) -> None:
+        self.options = dict(DEFAULT_RETRY_OPTIONS)
+        self.options.update(options or {})
+        self.rules = {name: dict(rule or {}) for name, rule in (rules or {}).items()}
+        self.stats = RetryStats()
+
+    @property
+    def interactive(self) -> bool:
+        return bool(self.options["interactive"])
+
+    def rule(self, err: Exception) -> Optional[Dict]:
+        """Options for `err`, or None if it should not be retried"""
+        for cls in type(err).__mro__:
+            name = cls.__name__
+            if name in self.rules:
+                rule = self.rules[name]
+                if not rule.get("retry", True):
+                    return None
+                options = dict(self.options)
+                options.update(rule)
+                return options
+            if name in RETRYABLE_ERRORS:
+                return self.options
+        return None
+
+    def retryable(self, err: Exception) -> bool:
+        return self.rule(err) is not None
+
+    def max_attempts(self, err: Exception) -> int:
+        rule = self.rule(err)
+        return int(rule["max_attempts"]) if rule is not None else 1
+
+    def delay(self, err: Exception, attempt: int) -> Optional[float]:
+        """
+        Seconds to wait before retrying after the `attempt`-th failed attempt,
+        or None if `err` is not retryable or the attempts are used up.
+        """
+        rule = self.rule(err)
+        if rule is None or attempt >= int(rule["max_attempts"]):
+            return None
+        if rule["respect_retry_after"]:
+            retry_after = parse_retry_after(err)
+            if retry_after is not None:
+                return min(float(rule["max_delay"]), retry_after)
+        backoff = float(rule["initial_delay"]) * float(rule["multiplier"]) ** (
+            attempt - 1
+        )
+        backoff = min(float(rule["max_delay"]), backoff)
+        jitter = min(max(float(rule["jitter"]), 0.0), 1.0)
+        return backoff * (1.0 - jitter * random.random())
+
+    def wait(self, err: Exception, delay: float) -> None:
+        """Sleep for `delay` seconds and account for it in the stats"""
+        self.stats.retries += 1
+        self.stats.record(err)
+        start = time.monotonic()
+        try:
+            time.sleep(delay)
+        finally:
+            self.stats.waited += time.monotonic() - start
+
+
+def parse_retry_after(err: Exception) -> Optional[float]:
+    """Seconds requested by the `Retry-After` header of an openai error"""
+    import email.utils
+
+    headers = getattr(err, "headers", None) or {}
+    value = None
+    for key in ["retry-after-ms", "Retry-After-Ms", "retry-after", "Retry-After"]:
+        if headers.get(key) is not None:
+            value = headers.get(key)
+            break
+    if value is None:
+        return None
+    try:
+        seconds = float(value)
+        if "ms" in key.lower():
+            seconds /= 1000.0
+        return max(seconds, 0.0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max((date - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+def setup_retry(options: Dict) -> None:
+    """Apply the `retry` section of `config.yaml`"""
+    global _policy
+    options = dict(options or {})
+    _rules.clear()
+    _rules.update(options.pop("rules", None) or {})
+    for key in DEFAULT_RETRY_OPTIONS:
+        if options.get(key) is not None:
+            _options[key] = options[key]
+    _policy = None
+
+
+def get_retry_policy() -> RetryPolicy:
+    """Return the shared retry policy, its stats live for the whole session"""
+    global _policy
+    if _policy is None:
+        _policy = RetryPolicy(_options, _rules)
+    return _policy
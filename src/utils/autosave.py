@@ -0,0 +1,220 @@
+"""
+Background writer for autosaving conversations.
+
+Saves are handed over to a writer thread, so persisting a conversation never
+blocks the prompt. Changes submitted for the same file are coalesced, and each
+file is written at most once per `interval` seconds.
+
+A write that fails is kept aside, and the next change submitted for the file
+writes a full snapshot instead of appending to a journal that may be missing
+the failed records.
+"""
+import atexit
+import os
+import threading
+import time
+from typing import Dict, List, Optional
+
+from utils.file import write_data
+from utils.io import printmd
+from utils.journal import BranchTree
+
+FSYNC_POLICIES = ["always", "exit", "never"]
+
+DEFAULT_AUTOSAVE_OPTIONS = {
+    "autosave": False,
+    "autosave_interval": 2.0,  # minimum seconds between two writes of a file
+    "fsync": "always",  # `always` after each write, only on `exit`, or `never`
+}
+
+_options = dict(DEFAULT_AUTOSAVE_OPTIONS)
+_writer = None
+
+
+class AutosaveJob:
+    def __init__(
+        self,
+        messages: List[Dict],
+        records: Optional[List[Dict]],
+        tree: Optional[BranchTree] = None,
+    ) -> None:
+        self.messages = messages
+        self.records = records  # None when a full snapshot has to be written
+        self.tree = tree
+        self.error: Optional[Exception] = None  # why the last write failed
+
+    def merge(
+        self,
+        messages: List[Dict],
+        records: Optional[List[Dict]],
+        tree: Optional[BranchTree] = None,
+    ) -> None:
+        self.messages = messages
+        self.tree = tree
+        if self.records is None or records is None:
+            self.records = None
+        else:
+            self.records.extend(records)
+
+
+class AutosaveWriter:
+    def __init__(self, interval: float = 2.0, fsync: str = "always") -> None:
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(
+                f"Invalid fsync policy `{fsync}`, expected {FSYNC_POLICIES}"
+            )
+        self.interval = float(interval)
+        self.fsync = fsync
+        self.jobs: Dict[str, AutosaveJob] = {}
+        # jobs that failed, as snapshots retried with the next change
+        self.failed: Dict[str, AutosaveJob] = {}
+        # files written without fsync, synced when the writer is closed
+        self.unsynced = set()
+        self.last_write: Dict[str, float] = {}
+        self.writing = 0
+        self.flushing = 0
+        self.error: Optional[Exception] = None
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(
+            target=self.__run, name="chatgpt-cli-autosave", daemon=True
+        )
+        self.thread.start()
+
+    def submit(
+        self,
+        filepath: str,
+        messages: List[Dict],
+        records: Optional[List[Dict]],
+        tree: Optional[BranchTree] = None,
+    ) -> None:
+        """
+        Queue `messages` to be written to `filepath`. `records` are the journal
+        records leading to `messages`, or None to write a full snapshot, and
+        `tree` holds all branches if there are others, see `write_data`. The
+        caller must not modify the submitted lists or dicts afterwards.
+        """
+        with self.cond:
+            if filepath in self.failed:
+                self.jobs[filepath] = self.failed.pop(filepath)
+            if filepath in self.jobs:
+                self.jobs[filepath].merge(messages, records, tree)
+            else:
+                self.jobs[filepath] = AutosaveJob(messages, records, tree)
+            self.cond.notify_all()
+
+    def take_failed(self, filepath: str) -> bool:
+        """
+        Whether the last write of `filepath` failed, in which case the caller
+        writes a full snapshot itself and the failed job is dropped
+        """
+        with self.cond:
+            return self.failed.pop(filepath, None) is not None
+
+    def __next_job(self):
+        """Wait for the next file that is due, return None once closed"""
+        with self.cond:
+            while True:
+                if self.closed and not self.jobs:
+                    return None
+                now = time.monotonic()
+                wait = None
+                for filepath in self.jobs:
+                    last = self.last_write.get(filepath)
+                    due = now if last is None else last + self.interval
+                    if self.closed or self.flushing or due <= now:
+                        self.writing += 1
+                        return filepath, self.jobs.pop(filepath)
+                    wait = due - now if wait is None else min(wait, due - now)
+                self.cond.wait(wait)
+
+    def __run(self) -> None:
+        while True:
+            item = self.__next_job()
+            if item is None:
+                return
+            filepath, job = item
+            fsync = self.fsync == "always" or (self.closed and self.fsync == "exit")
+            try:
+                write_data(
+                    job.messages, filepath, job.records, fsync=fsync, tree=job.tree
+                )
+            except Exception as e:
+                self.error = job.error = e
+                # the journal may lack these records now, append nothing more
+                # to it before a full snapshot was written
+                job.records = None
+                with self.cond:
+                    if filepath in self.jobs:
+                        self.jobs[filepath].records = None
+                    else:
+                        self.failed[filepath] = job
+            else:
+                with self.cond:
+                    if fsync:
+                        self.unsynced.discard(filepath)
+                    else:
+                        self.unsynced.add(filepath)
+            finally:
+                with self.cond:
+                    self.last_write[filepath] = time.monotonic()
+                    self.writing -= 1
+                    self.cond.notify_all()
+
+    def __sync(self) -> None:
+        """Sync the files written without fsync since their last sync"""
+        for filepath in self.unsynced:
+            try:
+                with open(filepath, "rb") as f:
+                    os.fsync(f.fileno())
+            except OSError:
+                pass  # removed or replaced by a store in the meantime
+        self.unsynced.clear()
+
+    def flush(self) -> None:
+        """Write everything queued right away and wait until it is on disk"""
+        with self.cond:
+            # queued files are due immediately while flushing
+            self.flushing += 1
+            self.cond.notify_all()
+            try:
+                while self.jobs or self.writing:
+                    self.cond.wait()
+            finally:
+                self.flushing -= 1
+
+    def close(self) -> None:
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        if self.fsync == "exit":
+            self.__sync()
+        for filepath, job in self.failed.items():
+            printmd(f"**[Autosave Error]**: `{filepath}` was not saved: {job.error}")
+
+
+def setup_autosave(options: Dict) -> None:
+    """Apply the autosave options of the `storage` section of `config.yaml`"""
+    options = options or {}
+    for key in DEFAULT_AUTOSAVE_OPTIONS:
+        if options.get(key) is not None:
+            _options[key] = options[key]
+
+
+def get_autosave_writer() -> Optional[AutosaveWriter]:
+    """Return the shared writer, or None if autosave is disabled"""
+    global _writer
+    if not _options["autosave"]:
+        return None
+    if _writer is None:
+        _writer = AutosaveWriter(_options["autosave_interval"], _options["fsync"])
+    return _writer
+
+
+@atexit.register
+def close_autosave_writer() -> None:
+    global _writer
+    if _writer is not None:
+        _writer.close()
+        _writer = None
@@ -1,6 +1,11 @@
 from chatgpt_cli.conversation import Conversation, Template
 from utils.io import *
 import re
+from typing import Tuple
+
+
+# responses `!regen <n>` may generate at once, and models `!compare` may ask
+MAX_CANDIDATES = 8
 
 
 def is_command(user_msg: str) -> bool:
@@ -9,6 +14,27 @@ def is_command(user_msg: str) -> bool:
     return user_msg.startswith("!") or user_msg in quit_words
 
 
+def parse_show_range(args: str, count: int) -> Tuple[int, int]:
+    """
+    Messages to show for `!show last <n>` or `!show range <a>-<b>`, as a
+    `(start, stop)` slice of `count` messages. Raise `ValueError` if invalid.
+    """
+    words = args.split()
+    if len(words) == 2 and words[0] == "last":
+        last = int(words[1])
+        if last < 0:
+            raise ValueError(args)
+        return max(count - last, 0), count
+    if len(words) == 2 and words[0] == "range":
+        first, _, last = words[1].partition("-")
+        start = int(first)
+        stop = int(last) + 1 if last else start + 1
+        if start < 0 or stop <= start:
+            raise ValueError(args)
+        return start, stop
+    raise ValueError(args)
+
+
 def execute_command(
     user_msg: str,
     conv: Conversation,
@@ -19,11 +45,18 @@ def execute_command(
         show_welcome_panel()
     elif user_msg in ["!show", "show"]:
         conv.show_history()
+    elif user_msg.startswith("!show "):
+        try:
+            start, stop = parse_show_range(user_msg[len("!show ") :], len(conv))
+            conv.show_history(start=start, stop=stop)
+        except ValueError:
+            printmd("**Usage: `!show`, `!show last <n>` or `!show range <a>-<b>`**")
+        user_msg = ""
     elif user_msg in ["!save", "save"]:
         conv.save(False)
     elif user_msg in ["!load", "load"]:
         conv.load()
-        conv.show_history(panel=False)
+        conv.show_history(panel=False, start=conv.history_window())
     elif user_msg in ["!new", "new", "reset", "!reset"]:
         conv.reset()
         conv.show_history(panel=False)
@@ -34,16 +67,76 @@ def execute_command(
         conv.resend()
     elif user_msg in ["!regen", "regen"]:
         conv.regen()
+    elif user_msg.startswith("!regen "):
+        count = user_msg[len("!regen ") :].strip()
+        if count.isdigit() and 1 <= int(count) <= MAX_CANDIDATES:
+            conv.regen(int(count))
+        else:
+            printmd(f"**Usage: `!regen [n]`, with n from 1 to {MAX_CANDIDATES}**")
+        user_msg = ""
+    elif user_msg in ["!model", "model"]:
+        printmd(f"**Model: `{conv.model}`**")
+    elif user_msg.startswith("!model "):
+        model = user_msg[len("!model ") :].strip()
+        if model and len(model.split()) == 1:
+            conv.set_model(model)
+        else:
+            printmd("**Usage: `!model [name]`**")
+        user_msg = ""
+    elif user_msg == "!compare" or user_msg.startswith("!compare "):
+        args = user_msg[len("!compare") :].replace(",", " ").split()
+        models = list(dict.fromkeys(args))
+        if 1 <= len(models) <= MAX_CANDIDATES:
+            conv.compare(models)
+        else:
+            printmd(
+                f"**Usage: `!compare model-a,model-b,...`, with up to {MAX_CANDIDATES} models**"
+            )
+        user_msg = ""
     elif user_msg in ["!edit", "edit"]:
         conv.edit_messages()
     elif user_msg in ["!drop", "drop"]:
         conv.drop_messages()
+    elif user_msg in ["!pin", "pin"]:
+        conv.pin_messages()
+    elif user_msg in ["!compact", "compact"]:
+        conv.compact()
+    elif user_msg in ["!branches", "branches", "!branch"]:
+        conv.show_branches()
+    elif user_msg.startswith("!branch "):
+        args = user_msg[len("!branch ") :].split()
+        if len(args) == 1:
+            conv.create_branch(args[0])
+        elif len(args) == 2 and args[1].isdigit():
+            conv.create_branch(args[0], int(args[1]))
+            conv.show_history(panel=False, start=conv.history_window())
+        else:
+            printmd("**Usage: `!branch <name> [n]`**")
+        user_msg = ""
+    elif user_msg.startswith("!checkout "):
+        args = user_msg[len("!checkout ") :].split()
+        if len(args) == 1:
+            conv.checkout(args[0])
+            conv.show_history(panel=False, start=conv.history_window())
+        else:
+            printmd("**Usage: `!checkout <name>`**")
+        user_msg = ""
+    elif user_msg in ["!token", "token"]:
+        conv.show_token_count()
     elif user_msg in ["!exit", "!quit", "quit", "exit", "!q"]:
         conv.save(True)
         print("Bye!")
         exit(0)
+    elif user_msg.startswith("!search"):
+        query = user_msg[len("!search") :].strip()
+        if query:
+            conv.search(query)
+        else:
+            printmd("**Usage: `!search <query>`**")
+        user_msg = ""  # the arguments are not a message to send
     elif user_msg.startswith("!tmpl"):
         tmpl.execute_command(user_msg, conv)
+        user_msg = ""
     elif user_msg.startswith("!"):
         print("Invalid command, please try again")
     return user_msg
@@ -1,95 +1,440 @@
+import itertools
 import os
 import json
+import sqlite3
+from datetime import datetime
+from rich.markup import escape
 import yaml
-from typing import Callable, Dict, List
+from typing import Callable, Dict, List, MutableSequence, Optional, Tuple
 
 from chatgpt_cli import __version__
+from utils.importer import (
+    CORRUPT,
+    DUPLICATE,
+    INVALID,
+    ImportReport,
+    content_digest,
+    parse_files,
+)
 from utils.io import *
+from utils.journal import (
+    BRANCH_OPS,
+    COMPRESSED_EXTENSION,
+    JOURNAL_EXTENSION,
+    MESSAGE_OPS,
+    BranchTree,
+    append_journal,
+    get_record_count,
+    is_compressed,
+    is_journal,
+    open_journal,
+    replay_journal,
+    write_journal,
+)
+from utils.manifest import list_manifest, update_manifest
+from utils.settings import (
+    get_config,
+    get_config_dir,
+    get_config_path,
+    get_patch,
+    get_patch_path,
+    thaw,
+)
+from utils.search import (
+    MATCH_END,
+    MATCH_START,
+    forget_conversation,
+    index_conversation,
+    refresh_index,
+    search,
+)
+from utils.store import STORE_FILENAME, get_store
+
+# file extension of each storage format for saved conversations, names of
+# conversations in the SQLite store have no extension
+STORAGE_FORMATS = {
+    "json": ".json",
+    "jsonl": JOURNAL_EXTENSION,
+    "jsonl.gz": COMPRESSED_EXTENSION,
+    "sqlite": "",
+}
+DEFAULT_STORAGE_OPTIONS = {"format": "jsonl"}
+
+IMPORT_REPORT_FILENAME = "import-report.jsonl"
+
+# journals of at least this many bytes are decoded lazily when loaded
+LAZY_LOAD_SIZE = 256 * 1024
+
+_storage = dict(DEFAULT_STORAGE_OPTIONS)
+_created_dirs = set()
+
+
+def setup_storage(options: Dict) -> None:
+    """Apply the `storage` section of `config.yaml`"""
+    options = options or {}
+    for key in DEFAULT_STORAGE_OPTIONS:
+        if options.get(key) is not None:
+            _storage[key] = options[key]
+    if _storage["format"] not in STORAGE_FORMATS:
+        raise ValueError(f"Invalid storage format `{_storage['format']}`")
+
+
+def get_storage_extension() -> str:
+    """File extension of newly saved conversations"""
+    return STORAGE_FORMATS[_storage["format"]]
+
+
+def is_data_file(filename: str) -> bool:
+    return any(filename.endswith(ext) for ext in STORAGE_FORMATS.values() if ext)
+
+
+def strip_extension(filename: str) -> str:
+    """Name of a data file without its extension, e.g. `a` for `a.jsonl.gz`"""
+    for ext in sorted(STORAGE_FORMATS.values(), key=len, reverse=True):
+        if ext and filename.endswith(ext):
+            return filename[: -len(ext)]
+    return filename
+
+
+def use_store() -> bool:
+    return _storage["format"] == "sqlite"
 
 
 def get_data_dir(create=True) -> str:
     """Data directory: `${HOME}/.config/chatgpt-cli/data`"""
     data_dir = os.path.join(get_config_dir(), "data")
-    if create and not os.path.exists(data_dir):
-        os.makedirs(data_dir)
+    if create and data_dir not in _created_dirs:
+        os.makedirs(data_dir, exist_ok=True)
+        _created_dirs.add(data_dir)
     return data_dir
 
 
-def save_data(data: List[Dict[str, str]], filename: str) -> None:
-    """Save list of dict to JSON file"""
+def get_data_path(filename: str) -> str:
+    """Path of a data file, with the default extension if `filename` has none"""
+    if not is_data_file(filename):
+        filename += get_storage_extension()
+    return os.path.join(get_data_dir(), filename)
+
+
+def write_data(
+    data: List[Dict[str, str]],
+    filepath: str,
+    records: List[Dict] = None,
+    fsync: bool = False,
+    tree: Optional[BranchTree] = None,
+) -> None:
+    """
+    Write list of dict to a JSON file or a JSONL journal. For an existing
+    journal, only `records` (the changes leading to `data`) are appended.
+    `tree` holds all branches of the conversation, `data` being the checked
+    out one, which is all other formats keep.
+    """
+    # the store and the search index only hold the checked out branch, which
+    # is written as a whole once another branch was checked out
+    flat_records = None
+    if records is not None and not any(r["op"] in BRANCH_OPS for r in records):
+        flat_records = [r for r in records if r["op"] in MESSAGE_OPS]
+    if not is_data_file(filepath):
+        store = get_store(os.path.dirname(filepath))
+        store.save(os.path.basename(filepath), data, flat_records)
+    elif is_journal(filepath):
+        if records is not None and os.path.exists(filepath):
+            append_journal(filepath, records, data, fsync=fsync, tree=tree)
+        else:
+            write_journal(filepath, data, fsync=fsync, tree=tree)
+    else:
+        # write to a temporary file first so a crash never leaves half a file
+        tmp_path = filepath + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=4)
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
+        os.replace(tmp_path, filepath)
+    # the store keeps its own listing, data files are listed from the manifest
+    if is_data_file(filepath):
+        try:
+            update_manifest(filepath, data)
+        except sqlite3.Error:
+            pass  # the entry is refreshed by the next listing instead
+    try:
+        index_conversation(filepath, data, flat_records)
+    except sqlite3.Error:
+        # the conversation is re-indexed by the next search instead
+        try:
+            forget_conversation(filepath)
+        except sqlite3.Error:
+            pass
+
+
+def save_data(
+    data: List[Dict[str, str]],
+    filename: str,
+    records: List[Dict] = None,
+    tree: Optional[BranchTree] = None,
+) -> None:
+    """Save list of dict to a data file, see `write_data`"""
 
     data_dir = get_data_dir()
     print("Data Directory: ", data_dir)
 
-    if filename.endswith(".json"):
-        filepath = os.path.join(data_dir, filename)
-    else:
-        filepath = os.path.join(data_dir, filename + ".json")
-    with open(filepath, "w") as f:
-        json.dump(data, f, indent=4)
+    filepath = get_data_path(filename)
+    write_data(data, filepath, records, fsync=True, tree=tree)
     print(f"Data saved to {filepath}")
 
 
-def load_data(messages: List[Dict[str, str]]) -> str:
-    """Load JSON file from 'data' directory to 'messages', and return the filepath"""
+def search_data(query: str, limit: int = 20) -> None:
+    """Search all saved conversations and print the best matching messages"""
+    data_dir = get_data_dir()
+    sources = {}
+    for file in os.listdir(data_dir):
+        if is_data_file(file):
+            stat = os.stat(os.path.join(data_dir, file))
+            sources[file] = (stat.st_mtime, stat.st_size)
+    if os.path.exists(os.path.join(data_dir, STORE_FILENAME)):
+        for c in get_store(data_dir).list():
+            sources[c["name"]] = (c["updated"], 0)
+    refresh_index(
+        data_dir, sources, lambda name: read_data(os.path.join(data_dir, name))
+    )
+
+    hits = search(data_dir, query, limit)
+    if not hits:
+        printmd(f"**No messages found for `{query}`.**")
+        return
+    print(f"Messages matching '{escape(query)}' (best matches first):\n")
+    for i, hit in enumerate(hits):
+        snippet = " ".join(escape(hit.snippet).split())
+        snippet = snippet.replace(MATCH_START, "[bold yellow]")
+        snippet = snippet.replace(MATCH_END, "[/bold yellow]")
+        print(f"{i + 1}. [bold]{escape(hit.name)}[/bold] #{hit.index} ({hit.role})")
+        print(f"    {snippet}")
+    print()
+
+
+def read_branches(filepath: str, lazy: bool = False) -> BranchTree:
+    """
+    Read all branches of a saved conversation, only journals have more than
+    one. With `lazy`, the messages of a large journal are decoded only when
+    accessed, see `LazyMessages`.
+    """
+    if not is_journal(filepath):
+        return BranchTree(read_data(filepath))
+    if (
+        lazy
+        and not is_compressed(filepath)
+        and os.path.getsize(filepath) >= LAZY_LOAD_SIZE
+    ):
+        return open_journal(filepath)
+    return replay_journal(filepath)
+
+
+def read_data(filepath: str) -> MutableSequence:
+    """Read the messages of a saved conversation, its checked out branch"""
+    if not is_data_file(filepath):
+        return get_store(os.path.dirname(filepath)).load(os.path.basename(filepath))
+    if is_journal(filepath):
+        # never repairs the journal, which may be appended to meanwhile
+        return replay_journal(filepath, repair=False).messages
+    with open(filepath, "r") as f:
+        return json.load(f)
+
+
+def load_data() -> Tuple[str, Optional[BranchTree]]:
+    """
+    Select a conversation in the data directory, and return its filepath and
+    branches, or an empty filepath if none was loaded
+    """
 
     data_dir = get_data_dir()
     print("Data Directory: ", data_dir)
 
-    files = [f for f in os.listdir(data_dir) if f.endswith(".json")]
+    if use_store():
+        conversations = get_store(data_dir).list()
+    else:
+        # only files changed since they were last listed or saved are read
+        conversations = list_manifest(
+            data_dir, is_data_file, lambda f: read_data(os.path.join(data_dir, f))
+        )
+    files = [c["name"] for c in conversations]
     if not files:
         print("No data files found in 'data' directory")
-        return ""
+        return "", None
 
     # prompt user to select a file to load
     print("Available data files:\n")
-    for i, f in enumerate(files):
-        print(f"{i + 1}. {f}")
+    for i, c in enumerate(conversations):
+        updated = datetime.fromtimestamp(c["updated"]).strftime("%Y-%m-%d %H:%M")
+        print(
+            f"{i + 1}. {escape(c['name'])} [{updated}, {c['message_count']} messages, {c['token_count']} tokens] {escape(c['title'])}"
+        )
     for a in range(3):
         try:
             selected_file = input(
                 f"\nEnter file number to load (1-{len(files)}), or Enter to start a fresh one: "
             )
             if not selected_file.strip():
-                return ""
+                return "", None
             index = int(selected_file) - 1
             if not 0 <= index < len(files):
                 raise ValueError()
             filepath = os.path.join(data_dir, files[index])
-            with open(filepath, "r") as f:
-                data = json.load(f)
-                messages.clear()
-                messages.extend(data)
+            tree = read_branches(filepath, lazy=True)
             print(f"Data loaded from {filepath}")
-            return filepath
+            return filepath, tree
         except (ValueError, IndexError):
             print("Invalid input, please try again")
         except (KeyboardInterrupt, EOFError):
             print("Aborting")
             exit(1)
     printmd("**[Warning]**: Too many invalid inputs, starting a fresh one")
-    return ""
+    return "", None
+
+
+def migrate_data_directory(directory: str = None) -> None:
+    """Import the data files of `directory` into the SQLite store"""
+    data_dir = get_data_dir()
+    directory = directory or data_dir
+    store = get_store(data_dir)
+    files = sorted(f for f in os.listdir(directory) if is_data_file(f))
+    imported, skipped, failed = 0, 0, 0
+    for file in files:
+        name = strip_extension(file)
+        if store.exists(name):
+            skipped += 1
+            continue
+        try:
+            data = read_data(os.path.join(directory, file))
+            if not isinstance(data, list):
+                raise ValueError("not a list of messages")
+            store.save(name, data)
+            imported += 1
+        except Exception as e:
+            printmd(f"**[Error]**: Failed to import `{file}`: {e}")
+            failed += 1
+    printmd(
+        f"**[Success]**: {imported} conversations imported to `{os.path.join(data_dir, STORE_FILENAME)}`, {skipped} already imported, {failed} failed"
+    )
+
+
+def _import_target(name: str, digest: str) -> Optional[str]:
+    """
+    Path to import a conversation `name` to, or None if the data directory
+    already has it. A different conversation of the same name is kept, and
+    the imported one gets a numbered name instead.
+    """
+    for i in itertools.count(1):
+        target = get_data_path(name if i == 1 else f"{name}-{i}")
+        if use_store():
+            exists = get_store(get_data_dir()).exists(os.path.basename(target))
+        else:
+            exists = os.path.exists(target)
+        if not exists:
+            return target
+        try:
+            if content_digest(read_data(target)) == digest:
+                return None
+        except (OSError, ValueError, KeyError):
+            pass
+
+
+def compact_data_directory() -> Dict[str, str]:
+    """
+    Convert the data files to compressed journals and rewrite compressed
+    journals holding many more records than messages. Return the new path of
+    every converted file.
+    """
+    data_dir = get_data_dir()
+    converted = {}
+    before, after = 0, 0
+    for file in sorted(os.listdir(data_dir)):
+        if not is_data_file(file):
+            continue
+        filepath = os.path.join(data_dir, file)
+        target = os.path.join(data_dir, strip_extension(file) + COMPRESSED_EXTENSION)
+        try:
+            size = os.path.getsize(filepath)
+            tree = read_branches(filepath)
+            if target == filepath:
+                if get_record_count(filepath) <= len(tree.records()):
+                    continue  # nothing to gain
+            elif os.path.exists(target):
+                printmd(f"**[Warning]**: `{file}` skipped, `{target}` already exists")
+                continue
+            write_data(tree.messages, target, fsync=True, tree=tree)
+            if target != filepath:
+                os.remove(filepath)
+                converted[filepath] = target
+        except (OSError, ValueError, KeyError, IndexError) as e:
+            printmd(f"**[Error]**: Failed to compact `{file}`: {e}")
+            continue
+        before += size
+        after += os.path.getsize(target)
+    printmd(
+        f"**[Success]**: {len(converted)} conversations converted to `{COMPRESSED_EXTENSION}`, {before / 1024:.1f} KiB compacted to {after / 1024:.1f} KiB"
+    )
+    return converted
 
 
-def import_data_directory():
+def import_data_directory(directory: str = None, jobs: int = None) -> None:
+    """Import the conversations of another data directory, see `utils.importer`"""
+    from rich.progress import Progress
+    from rich.table import Table
+
     data_dir = get_data_dir()  # will create the data directory
     for i in range(3):
-        try:
-            old_data_dir = input(
+        if directory is None:
+            directory = input(
                 "Enter absolute path to the data directory containing *.json files (e.g., /absolute/path/to/data/): "
             ).strip()
-            for file in os.listdir(old_data_dir):
-                if file.endswith(".json"):
-                    with open(os.path.join(old_data_dir, file), "r") as f:
-                        data = json.load(f)
-                    with open(os.path.join(data_dir, file), "w") as f:
-                        json.dump(data, f)
+        if os.path.isdir(directory):
             break
-        except FileNotFoundError:
-            printmd("**[File Not Found Error]**: Please check the path and try again")
-        except Exception as e:
-            printmd(f"**[Unknown Error]**: {e}")
-    printmd(f"**[Success]**: Data files imported to `{data_dir}`")
+        printmd("**[File Not Found Error]**: Please check the path and try again")
+        directory = None
+    else:
+        return
+    directory = os.path.abspath(directory)
+    if directory == os.path.abspath(data_dir):
+        printmd("**[Error]**: Cannot import the data directory into itself")
+        return
+    files = sorted(f for f in os.listdir(directory) if is_data_file(f))
+    report = ImportReport()
+    seen: Dict[str, str] = {}
+    with Progress(console=console, transient=True) as progress:
+        task = progress.add_task("Importing", total=len(files))
+        paths = [os.path.join(directory, f) for f in files]
+        for file, result in zip(files, parse_files(paths, jobs)):
+            progress.advance(task)
+            if result["reason"] is not None:
+                report.add(file, result["reason"], result["error"])
+                continue
+            digest = result["digest"]
+            if digest in seen:
+                report.add(file, DUPLICATE, f"same messages as `{seen[digest]}`")
+                continue
+            seen[digest] = file
+            target = _import_target(strip_extension(file), digest)
+            if target is None:
+                report.add(file, DUPLICATE, "already in the data directory")
+                continue
+            write_data(result["messages"], target)
+            report.imported += 1
+    printmd(
+        f"**[Success]**: {report.imported} conversations imported to `{data_dir}`, {report.count(DUPLICATE)} duplicates, {report.count(CORRUPT)} corrupt and {report.count(INVALID)} invalid files skipped"
+    )
+    if report.skipped:
+        table = Table("File", "Reason", "Details")
+        # files that are broken are more interesting than duplicates
+        order = [CORRUPT, INVALID, DUPLICATE]
+        skipped_files = sorted(report.skipped, key=lambda s: order.index(s["reason"]))
+        for skipped in skipped_files[:20]:
+            table.add_row(
+                escape(skipped["file"]), skipped["reason"], escape(skipped["error"])
+            )
+        print(table)
+        report_path = os.path.join(get_config_dir(), IMPORT_REPORT_FILENAME)
+        report.write(report_path)
+        print(f"All {len(report.skipped)} skipped files are listed in {report_path}")
 
 
 def create_data_directory():
@@ -97,18 +442,6 @@ def create_data_directory():
     printmd(f"**[Success]**: Data directory created at `{data_dir}`")
 
 
-def get_config_dir() -> str:
-    """Config directory: `${HOME}/.config/chatgpt-cli`"""
-    config_dir = os.path.join(os.path.expanduser("~"), ".config", "chatgpt-cli")
-    if not os.path.exists(config_dir):
-        os.makedirs(config_dir)
-    return config_dir
-
-
-def get_config_path() -> str:
-    return os.path.join(get_config_dir(), "config.yaml")
-
-
 def save_config_yaml(config: Dict):
     config_path = get_config_path()
     with open(config_path, "w") as f:
@@ -162,6 +495,7 @@ def create_config_yaml():
 
 
 def load_config() -> Dict:
+    """Read-only contents of `config.yaml`, running the setup if there is none"""
     # check setup
     config_path = get_config_path()
     if not os.path.exists(config_path):
@@ -174,12 +508,12 @@ def load_config() -> Dict:
         else:
             create_config_yaml()
     # load configurations from config.yaml
-    with open(config_path, "r") as f:
-        try:
-            config = yaml.safe_load(f)
-        except yaml.YAMLError:
-            print("Error in configuration file:", config_path)
-            exit(1)
+    try:
+        config = get_config()
+    except (yaml.YAMLError, ValueError) as e:
+        print("Error in configuration file:", config_path)
+        printmd(f"**[Error]**: {e}")
+        exit(1)
     if not os.path.exists(get_data_dir(create=False)):
         choose = input(
             "Do you want to import previous data files [*.json]? [y/n]: "
@@ -193,30 +527,22 @@ def load_config() -> Dict:
 
 
 def load_patch() -> Dict:
-    """Load the patch file"""
-    patch_path = get_patch_path()
-    with open(patch_path, "r") as f:
-        try:
-            patch = yaml.safe_load(f)
-        except yaml.YAMLError:
-            print("Error in patch file:", patch_path)
-            exit(1)
-    return patch
-
-
-def get_patch_path():
-    patch_path = os.path.join(get_config_dir(), "patch.yaml")
-    if not os.path.exists(patch_path):
-        with open(patch_path, "w") as f:
-            yaml.dump({}, f, indent=2)
-    return patch_path
+    """Load the patch file, as a copy that can be modified and saved"""
+    try:
+        return thaw(get_patch())
+    except (yaml.YAMLError, ValueError) as e:
+        print("Error in patch file:", get_patch_path())
+        printmd(f"**[Error]**: {e}")
+        exit(1)
 
 
 def save_patch(patch: Dict):
     """Save the patch file"""
-    patch_path = os.path.join(get_config_dir(), "patch.yaml")
-    with open(patch_path, "w") as f:
+    patch_path = get_patch_path()
+    tmp_path = patch_path + ".tmp"
+    with open(tmp_path, "w") as f:
         yaml.dump(patch, f, indent=2)
+    os.replace(tmp_path, patch_path)
     printmd(f"**[Success]**: `patch.yaml` file saved to `{patch_path}`")
 
 
@@ -315,12 +641,6 @@ def create_template(patch: Dict):
     printmd(f"**[Success]**: Template `{template_name}` created")
 
 
-def load_templates() -> List[Dict]:
-    """Load the templates from the `patch.yaml` file"""
-    patch = load_patch()
-    return patch.get("templates", [])
-
-
 def edit_template(patch: Dict):
     printpnl("**[Error]**: Not implemented yet")
 
@@ -0,0 +1,119 @@
+"""
+Import of conversations from another data directory.
+
+Files are read and validated in a pool of worker processes, and the parent
+only writes the conversations that passed. Conversations with the same
+messages are imported once, and every file that is skipped (a duplicate, not
+valid JSON, or not a list of messages) is listed in a report. Only the
+checked out branch of a journal is imported.
+"""
+import gzip
+import hashlib
+import json
+import os
+from typing import Dict, Iterable, List, Optional
+
+from utils.journal import BranchTree, is_compressed, is_journal
+from utils.settings import ROLES
+
+# below this many files, starting worker processes costs more than it saves
+POOL_THRESHOLD = 64
+
+# reasons a file is skipped
+CORRUPT = "corrupt"
+INVALID = "invalid"
+DUPLICATE = "duplicate"
+
+
+def validate_messages(data) -> None:
+    """Raise `ValueError` unless `data` is a non-empty list of messages"""
+    if not isinstance(data, list):
+        raise ValueError("not a list of messages")
+    if not data:
+        raise ValueError("no messages")
+    for i, message in enumerate(data):
+        if not isinstance(message, dict):
+            raise ValueError(f"message {i} is not an object")
+        if message.get("role") not in ROLES:
+            raise ValueError(f"message {i} has an invalid role {message.get('role')!r}")
+        if not isinstance(message.get("content"), str):
+            raise ValueError(f"message {i} has no text content")
+        if not isinstance(message.get("name", ""), str):
+            raise ValueError(f"message {i} has an invalid name")
+
+
+def read_messages(filepath: str) -> List[Dict]:
+    """Read a JSON file or a journal, without repairing anything in place"""
+    opener = gzip.open if is_compressed(filepath) else open
+    with opener(filepath, "rt", encoding="utf-8") as f:
+        if not is_journal(filepath):
+            return json.load(f)
+        tree = BranchTree()
+        for line in f:
+            if line.strip():
+                tree.apply(json.loads(line))
+        return tree.messages
+
+
+def content_digest(messages: List[Dict]) -> str:
+    data = json.dumps(messages, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def parse_file(filepath: str) -> Dict:
+    """
+    Read and validate one file, run in a worker process. Returns the messages
+    and their digest, or the reason and error the file is skipped for.
+    """
+    result = {"file": filepath, "messages": None, "digest": None, "reason": None}
+    try:
+        messages = read_messages(filepath)
+    except (
+        OSError,
+        EOFError,
+        UnicodeDecodeError,
+        ValueError,
+        KeyError,
+        IndexError,
+    ) as e:
+        # broken JSON, a journal record that does not apply, or an unreadable file
+        result.update(reason=CORRUPT, error=f"{type(e).__name__}: {e}")
+        return result
+    try:
+        validate_messages(messages)
+    except ValueError as e:
+        result.update(reason=INVALID, error=str(e))
+        return result
+    result.update(messages=messages, digest=content_digest(messages))
+    return result
+
+
+def parse_files(filepaths: List[str], jobs: Optional[int] = None) -> Iterable[Dict]:
+    """Parse `filepaths` in parallel, yielding the results in the same order"""
+    if len(filepaths) < POOL_THRESHOLD or jobs == 1:
+        yield from map(parse_file, filepaths)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+
+    jobs = jobs or os.cpu_count() or 1
+    chunksize = max(1, min(64, len(filepaths) // (jobs * 8)))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        yield from executor.map(parse_file, filepaths, chunksize=chunksize)
+
+
+class ImportReport:
+    def __init__(self) -> None:
+        self.imported = 0
+        self.skipped: List[Dict] = []
+
+    def add(self, file: str, reason: str, error: str) -> None:
+        self.skipped.append({"file": file, "reason": reason, "error": error})
+
+    def count(self, reason: str) -> int:
+        return sum(1 for s in self.skipped if s["reason"] == reason)
+
+    def write(self, path: str) -> None:
+        """Write the skipped files as JSONL"""
+        with open(path, "w", encoding="utf-8") as f:
+            for skipped in self.skipped:
+                f.write(json.dumps(skipped, ensure_ascii=False) + "\n")
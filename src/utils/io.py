@@ -1,22 +1,37 @@
+import hashlib
+import itertools
 import os
 import sys
-import tempfile
 import readline
-import subprocess
+import time
 
+from collections import OrderedDict
 from typing import Dict
 from typing import Generator
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
 
 from rich import print
 from rich.console import Console
-from rich.live import Live
 from rich.markdown import Markdown
 from rich.panel import Panel
+from rich.segment import Segment, Segments
 
 from chatgpt_cli import __version__
 
 console = Console()
 
+ROLE_LABELS = {"user": "User", "assistant": "ChatGPT", "system": "System"}
+
+# rendered messages kept by `render_cache`
+RENDER_CACHE_SIZE = 512
+
+# how many times per second the open tail of a streamed reply is re-rendered
+DEFAULT_STREAM_REFRESH_PER_SECOND = 8.0
+STREAM_REFRESH_PER_SECOND = DEFAULT_STREAM_REFRESH_PER_SECOND
+
 
 def print(*args, **kwargs) -> None:
     console.print(*args, **kwargs)
@@ -39,17 +54,59 @@ def printmd(msg: str, newline=True) -> None:
         print()
 
 
-def show_message(msg: Dict[str, str]) -> None:
-    role = msg["role"]
-    content = msg["content"]
-    if role == "user":
-        user_output(content)
-    elif role == "assistant":
-        assistant_output(content)
-    elif role == "system":
-        system_output(content)
-    else:
+def message_markdown(role: str, content: str) -> Markdown:
+    if role not in ROLE_LABELS:
         raise ValueError(f"Invalid role: {role}")
+    return Markdown(f"**{ROLE_LABELS[role]}:** {content}")
+
+
+class RenderCache:
+    """
+    Rendered lines of messages, keyed by content hash, terminal width and
+    role. Showing a message again (in the history, or while editing, dropping
+    or pinning) reuses its lines instead of parsing and laying out its
+    markdown again. The least recently used entries are evicted beyond
+    `maxsize`, which is also how the lines of an edited message go away.
+    """
+
+    def __init__(self, maxsize: int = RENDER_CACHE_SIZE) -> None:
+        self.maxsize = maxsize
+        self.entries: "OrderedDict[Tuple[str, int, str], Tuple[List[Segment], int]]" = (
+            OrderedDict()
+        )
+
+    @staticmethod
+    def digest(msg: Dict[str, str]) -> str:
+        return hashlib.sha1(msg["content"].encode("utf-8")).hexdigest()
+
+    def get(self, msg: Dict[str, str], width: int) -> Tuple[List[Segment], int]:
+        """Rendered segments of `msg` at `width`, and their number of lines"""
+        key = (self.digest(msg), width, msg["role"])
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            return entry
+        markdown = message_markdown(msg["role"], msg["content"])
+        segments = list(console.render(markdown, console.options.update_width(width)))
+        entry = segments, sum(segment.text.count("\n") for segment in segments)
+        self.entries[key] = entry
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+        return entry
+
+
+render_cache = RenderCache()
+
+
+def message_height(msg: Dict[str, str]) -> int:
+    """Number of terminal lines `show_message` prints for `msg`"""
+    return render_cache.get(msg, console.width)[1] + 1  # and the blank line
+
+
+def show_message(msg: Dict[str, str]) -> None:
+    segments, _ = render_cache.get(msg, console.width)
+    console.print(Segments(segments))
+    print()
 
 
 def user_output(msg: str) -> None:
@@ -60,15 +117,174 @@ def assistant_output(msg: str) -> None:
     printmd("**ChatGPT:** {}".format(msg))
 
 
-def assistant_stream(gen: Generator[str, None, None]) -> str:
-    msg = ""
+def set_stream_refresh_rate(refresh_per_second: Optional[float]) -> None:
+    """Set the refresh rate used by `assistant_stream`, None for the default"""
+    global STREAM_REFRESH_PER_SECOND
+    if refresh_per_second is None:
+        refresh_per_second = DEFAULT_STREAM_REFRESH_PER_SECOND
+    elif refresh_per_second <= 0:
+        printmd(
+            f"**[Warning]**: `chat.refresh_per_second` must be positive, using {DEFAULT_STREAM_REFRESH_PER_SECOND}"
+        )
+        refresh_per_second = DEFAULT_STREAM_REFRESH_PER_SECOND
+    STREAM_REFRESH_PER_SECOND = float(refresh_per_second)
 
-    with Live(vertical_overflow="visible") as live:
-        for text in gen:
-            msg += text
-            live.update(Markdown("**ChatGPT:** " + msg))
 
-    return msg
+class MarkdownStream:
+    """
+    Incrementally split a streamed markdown reply into blocks.
+
+    Closed paragraphs and closed fenced code blocks are returned once by `feed`
+    so they can be rendered a single time; only the open tail block has to be
+    re-rendered while the reply is still growing.
+    """
+
+    def __init__(self) -> None:
+        self.text = ""
+        self.frozen = 0  # offset of the open tail block in `text`
+        self.scanned = 0  # offset of the first line not scanned yet
+        self.fence = ""  # marker of the currently open fence, if any
+        self.blank = -1  # offset after a blank line that may end a block
+
+    @property
+    def tail(self) -> str:
+        return self.text[self.frozen :]
+
+    def __freeze(self, end: int) -> str:
+        block = self.text[self.frozen : end].strip("\n")
+        self.frozen = end
+        self.blank = -1
+        return block
+
+    def feed(self, chunk: str) -> List[str]:
+        """Append `chunk` and return the blocks that have been closed by it"""
+        self.text += chunk
+        blocks = []
+        while True:
+            newline = self.text.find("\n", self.scanned)
+            if newline < 0:
+                break
+            line = self.text[self.scanned : newline]
+            self.scanned = newline + 1
+            stripped = line.strip()
+            if self.fence:
+                if stripped.startswith(self.fence) and not stripped.strip(
+                    self.fence[0]
+                ):
+                    self.fence = ""
+                    blocks.append(self.__freeze(self.scanned))
+                continue
+            if not stripped:
+                if self.blank < 0 and self.text[self.frozen : newline].strip():
+                    self.blank = self.scanned
+                continue
+            # a blank line only ends a block if the next line is not indented,
+            # otherwise it may belong to a list item or an indented code block
+            if self.blank >= 0 and not line[:1].isspace():
+                end = self.text.rfind("\n", 0, self.blank - 1) + 1
+                if end > self.frozen:
+                    blocks.append(self.__freeze(end))
+            self.blank = -1
+            if stripped.startswith("```") or stripped.startswith("~~~"):
+                marker = stripped[0] * (len(stripped) - len(stripped.lstrip("`~")))
+                self.fence = marker
+        return [b for b in blocks if b]
+
+
+def assistant_stream(
+    gen: Generator[str, None, None], refresh_per_second: float = None
+) -> str:
+    if refresh_per_second is None:
+        refresh_per_second = STREAM_REFRESH_PER_SECOND
+    interval = 1.0 / refresh_per_second
+    stream = MarkdownStream()
+    prefix = "**ChatGPT:** "
+
+    # the generator shows its own status spinner until the first chunk arrives,
+    # which cannot be nested in another live display
+    gen = iter(gen)
+    first = next(gen, None)
+    if first is None:
+        return ""
+    gen = itertools.chain([first], gen)
+
+    from rich.live import Live
+
+    with Live(
+        console=console,
+        refresh_per_second=refresh_per_second,
+        vertical_overflow="visible",
+    ) as live:
+        last_update = 0.0
+        for text in gen:
+            for block in stream.feed(text):
+                live.console.print(Markdown(prefix + block))
+                prefix = ""
+            now = time.monotonic()
+            if now - last_update >= interval:
+                live.update(Markdown(prefix + stream.tail))
+                last_update = now
+        live.update(Markdown(prefix + stream.tail), refresh=True)
+
+    return stream.text
+
+
+def split_view(texts: List[str], titles: List[str]):
+    """Replies side by side, one column per title"""
+    from rich.table import Table
+
+    grid = Table.grid(expand=True, padding=(0, 1))
+    for _ in titles:
+        grid.add_column(ratio=1)
+    grid.add_row(
+        *[
+            Panel(Markdown(text), title=title, border_style="blue")
+            for text, title in zip(texts, titles)
+        ]
+    )
+    return grid
+
+
+def split_stream(
+    gen: Iterator[Tuple[int, str]],
+    titles: List[str],
+    refresh_per_second: float = None,
+) -> List[str]:
+    """
+    Stream several replies side by side. `gen` yields `(column, chunk)` pairs,
+    return the text of every column.
+    """
+    if refresh_per_second is None:
+        refresh_per_second = STREAM_REFRESH_PER_SECOND
+    interval = 1.0 / refresh_per_second
+    texts = [""] * len(titles)
+
+    # see `assistant_stream`, the spinner of `gen` runs until the first chunk
+    gen = iter(gen)
+    first = next(gen, None)
+    if first is None:
+        return texts
+    gen = itertools.chain([first], gen)
+
+    from rich.live import Live
+
+    # the columns only grow at the bottom, so the live view is cropped to the
+    # screen and the full view is printed once every reply is complete
+    with Live(
+        console=console,
+        refresh_per_second=refresh_per_second,
+        vertical_overflow="crop",
+        transient=True,
+    ) as live:
+        last_update = 0.0
+        for column, chunk in gen:
+            texts[column] += chunk
+            now = time.monotonic()
+            if now - last_update >= interval:
+                live.update(split_view(texts, titles))
+                last_update = now
+    print(split_view(texts, titles))
+    return texts
 
 
 def system_output(msg: str) -> None:
@@ -107,6 +323,9 @@ def input_error_handler(is_modified: bool, e: Exception) -> None:
 
 
 def input_from_editor() -> str:
+    import subprocess
+    import tempfile
+
     editor = os.environ.get("EDITOR", "vim")
     initial_message = b""
 
@@ -156,18 +375,30 @@ Here are some useful commands you may want to use:
 
 - `!help` or `!h`: show this message
 - `!show`: show current conversation messages
+- `!show last <n>` or `!show range <a>-<b>`: show only some of the messages
 - `!save`: save current conversation to a `JSON` file
 - `!load`: load a conversation from a `JSON` file
 - `!new` or `!reset`: start a new conversation
 - `!editor` or `!e`: use your default editor (e.g. vim) to submit a message
 - `!regen`: regenerate the last response
+- `!regen <n>`: generate `n` responses at once and pick one
 - `!resend`: resend your last prompt to generate response
 - `!edit`: select messages to edit
 - `!drop`: select messages to drop
+- `!pin`: select messages to pin, pinned messages are always kept in the context window
+- `!branch <name> [n]`: fork a branch with the first `n` messages (all by default)
+- `!checkout <name>`: switch to another branch
+- `!branches`: list the branches of the conversation
+- `!model [name]`: show or switch the model of the current conversation
+- `!compare model-a,model-b`: send the last prompt to several models and compare them
+- `!token`: count tokens in the current conversation
+- `!compact`: compress saved conversations
+- `!search <query>`: search messages of all saved conversations
 - `!exit` or `!quit` or `!q`: exit the program
 
 Features (under development):
 - `!tmpl` or `!tmpl load`: select a template to use
+- `!tmpl <name|alias>`: switch to a template directly, e.g. `!tmpl tr`
 - `!tmpl show`: show all templates with complete information
 - `!tmpl create`: create a new template
 - `!tmpl edit`: edit an existing template (not implemented yet)
@@ -0,0 +1,590 @@
+"""
+Append-only journal storage for conversations.
+
+A journal is a JSONL file with one record per line:
+
+- `{"op": "append", "message": {...}}` adds a message at the end
+- `{"op": "set", "index": i, "message": {...}}` replaces message `i`
+- `{"op": "drop", "index": i}` removes message `i`
+- `{"op": "branch", "name": b, "from": a, "at": n}` starts branch `b` with the
+  first `n` messages of branch `a`
+- `{"op": "checkout", "name": b}` makes the following records apply to `b`
+- `{"op": "model", "model": m}` sets the model of the conversation
+
+Saving a turn appends a few records instead of rewriting the whole
+conversation. Once a journal holds too many records compared to the messages
+they produce, it is compacted: the messages are written as plain `append`
+records to a temporary file which atomically replaces the journal.
+
+Records apply to the `main` branch until another one is checked out. A branch
+shares the messages of its parent up to the fork (the same parts of memory, see
+`Segments`), and a compacted journal writes each branch as a fork of the branch
+it has the longest common prefix with, so shared messages are written once.
+
+A compressed journal (`.jsonl.gz`) holds the same records, gzip-compressed.
+Every write adds one complete gzip member, and the members are decompressed
+one after another when reading, so appending never rewrites the file either.
+"""
+import gzip
+import itertools
+import json
+import mmap
+import os
+import re
+import threading
+import zlib
+from collections.abc import MutableSequence, Sequence
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+JOURNAL_EXTENSION = ".jsonl"
+COMPRESSED_EXTENSION = ".jsonl.gz"
+
+GZIP_MAGIC = b"\x1f\x8b\x08"
+
+MAIN_BRANCH = "main"
+# records changing messages, the others change the branches or the model
+MESSAGE_OPS = ["append", "set", "drop"]
+BRANCH_OPS = ["branch", "checkout"]
+
+# records are written with their keys in this order, so the operation and index
+# of a record can be read from the start of its line without decoding it
+RECORD_PREFIX = re.compile(rb'\{"op":"(append|set|drop)"(?:,"index":(\d+))?')
+
+# compact once there are more than `ratio * messages + slack` records
+COMPACT_RATIO = 2
+COMPACT_SLACK = 32
+
+# number of records in each journal written or repaired by this process, so
+# that deciding whether to compact never needs to read the file again
+_record_counts: Dict[str, int] = {}
+_record_counts_lock = threading.Lock()
+
+
+def is_journal(filepath: str) -> bool:
+    return filepath.endswith(JOURNAL_EXTENSION) or is_compressed(filepath)
+
+
+def is_compressed(filepath: str) -> bool:
+    return filepath.endswith(COMPRESSED_EXTENSION)
+
+
+def _dumps(record: Dict) -> str:
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+
+def _sync(f, fsync: bool) -> None:
+    f.flush()
+    if fsync:
+        os.fsync(f.fileno())
+
+
+def _write(path: str, mode: str, text: str, compressed: bool, fsync: bool) -> None:
+    data = text.encode("utf-8")
+    if compressed:
+        data = gzip.compress(data)
+    with open(path, mode) as f:
+        f.write(data)
+        _sync(f, fsync)
+
+
+def _decompress(raw: bytes) -> Tuple[bytes, int]:
+    """
+    Decompress the gzip members in `raw`, return their contents and the size
+    of the members that are complete.
+    """
+    chunks = []
+    end = 0
+    while end < len(raw):
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            chunk = d.decompress(raw[end:])
+        except zlib.error:
+            break
+        if not d.eof:
+            break
+        chunks.append(chunk)
+        end = len(raw) - len(d.unused_data)
+    return b"".join(chunks), end
+
+
+def apply_record(messages: List[Dict], record: Dict) -> None:
+    op = record.get("op")
+    if op == "append":
+        messages.append(record["message"])
+    elif op == "set":
+        messages[record["index"]] = record["message"]
+    elif op == "drop":
+        messages.pop(record["index"])
+    else:
+        raise ValueError(f"Invalid journal record: {record}")
+
+
+def shared_prefix(a: MutableSequence, b: MutableSequence) -> int:
+    """Number of leading messages `a` and `b` have in common"""
+    count = 0
+    for x, y in zip(a, b):
+        if x is not y and x != y:
+            break
+        count += 1
+    return count
+
+
+class Segments(Sequence):
+    """
+    Read-only messages of a branch that is not checked out, made of parts
+    `(messages, count)`: the first `count` items of a tuple that may be shared
+    with other branches. A branch forked from another one only adds a part
+    for the messages it changed or added after the fork.
+    """
+
+    def __init__(self, parts: Iterable[Tuple[tuple, int]] = ()) -> None:
+        self.parts = tuple(parts)
+        self.length = sum(count for _, count in self.parts)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self) -> Iterator:
+        for messages, count in self.parts:
+            yield from itertools.islice(messages, count)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self)[i]
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError(i)
+        for messages, count in self.parts:
+            if i < count:
+                return messages[i]
+            i -= count
+
+    def prefix(self, count: int) -> "Segments":
+        """The first `count` messages, sharing the parts they are in"""
+        parts = []
+        for messages, n in self.parts:
+            if count <= 0:
+                break
+            parts.append((messages, min(n, count)))
+            count -= n
+        return Segments(parts)
+
+    def extend(self, messages: Sequence) -> "Segments":
+        if not messages:
+            return self
+        return Segments(self.parts + ((tuple(messages), len(messages)),))
+
+
+class BranchTree:
+    """
+    Branches of a conversation and the model it uses. The checked out branch
+    `current` is a plain list of `messages`, the other branches are stored as
+    `Segments` sharing their common messages. `base` is what the checked out
+    branch was made from, and its first `base_count` messages are unchanged
+    since, so storing the branch again only adds a part for the rest.
+    """
+
+    def __init__(
+        self,
+        messages: MutableSequence = None,
+        current: str = MAIN_BRANCH,
+        branches: Dict[str, Segments] = None,
+        model: Optional[str] = None,
+    ) -> None:
+        self.messages = [] if messages is None else messages
+        self.current = current
+        self.branches = {} if branches is None else branches
+        self.model = model
+        self.base = Segments()
+        self.base_count = 0
+
+    def names(self) -> List[str]:
+        """Names of all branches, the main branch first"""
+        names = [self.current, *self.branches]
+        return sorted(names, key=lambda name: name != MAIN_BRANCH)
+
+    def get(self, name: str) -> Sequence:
+        return self.messages if name == self.current else self.branches[name]
+
+    def size(self) -> int:
+        """Messages of all branches, the most records a compact journal needs"""
+        return len(self.messages) + sum(len(b) for b in self.branches.values())
+
+    def changed(self, index: int) -> None:
+        """Message `index` of the checked out branch was replaced or removed"""
+        self.base_count = min(self.base_count, index)
+
+    def freeze(self) -> Segments:
+        """The checked out branch as `Segments`, sharing the parts of `base`"""
+        self.base = self.base.prefix(self.base_count).extend(
+            self.messages[self.base_count :]
+        )
+        self.base_count = len(self.messages)
+        return self.base
+
+    def __branch(self, name: str) -> Segments:
+        if name == self.current:
+            return self.freeze()
+        if name not in self.branches:
+            raise ValueError(f"Unknown branch `{name}`")
+        return self.branches[name]
+
+    def fork(self, name: str, parent: str, at: int) -> None:
+        """Start branch `name` with the first `at` messages of `parent`"""
+        if name == self.current or name in self.branches:
+            raise ValueError(f"Branch `{name}` already exists")
+        source = self.__branch(parent)
+        if not 0 <= at <= len(source):
+            raise ValueError(f"Branch `{parent}` has no {at} messages")
+        self.branches[name] = source.prefix(at)
+
+    def checkout(self, name: str) -> None:
+        if name == self.current:
+            return
+        stored = self.__branch(name)
+        self.branches[self.current] = self.freeze()
+        del self.branches[name]
+        self.current = name
+        self.messages = list(stored)
+        self.base = stored
+        self.base_count = len(stored)
+
+    def apply(self, record: Dict) -> None:
+        op = record.get("op")
+        if op == "branch":
+            self.fork(record["name"], record["from"], record["at"])
+        elif op == "checkout":
+            self.checkout(record["name"])
+        elif op == "model":
+            self.model = record["model"]
+        else:
+            apply_record(self.messages, record)
+            if op != "append":
+                self.changed(record["index"])
+
+    def copy(self, messages: MutableSequence) -> "BranchTree":
+        """
+        A tree with `messages` as the checked out branch, sharing the other
+        branches, which are never changed (only replaced) once stored.
+        """
+        return BranchTree(messages, self.current, dict(self.branches), self.model)
+
+    def records(self) -> List[Dict]:
+        """Records of a compact journal leading to this tree"""
+        records = []
+        if self.model is not None:
+            records.append({"op": "model", "model": self.model})
+        written: List[str] = []
+        # the records start out on the main branch
+        for name in self.names():
+            messages = self.get(name)
+            at, parent = 0, None
+            for other in written:
+                shared = shared_prefix(self.get(other), messages)
+                if parent is None or shared > at:
+                    at, parent = shared, other
+            if parent is not None:
+                records.append({"op": "branch", "name": name, "from": parent, "at": at})
+                records.append({"op": "checkout", "name": name})
+            records.extend({"op": "append", "message": m} for m in messages[at:])
+            written.append(name)
+        if written[-1] != self.current:
+            records.append({"op": "checkout", "name": self.current})
+        return records
+
+
+def _set_record_count(filepath: str, count: int) -> None:
+    with _record_counts_lock:
+        _record_counts[filepath] = count
+
+
+def _member_follows(raw: bytes, start: int) -> bool:
+    """
+    Whether a complete gzip member starts after offset `start`. The magic bytes
+    may occur inside compressed data too, so each match is decompressed.
+    """
+    start = raw.find(GZIP_MAGIC, start)
+    while start != -1:
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            d.decompress(raw[start:])
+        except zlib.error:
+            pass
+        if d.eof:
+            return True
+        start = raw.find(GZIP_MAGIC, start + 1)
+    return False
+
+
+def _read_compressed(filepath: str, repair: bool) -> BranchTree:
+    with open(filepath, "rb") as f:
+        raw = f.read()
+    data, end = _decompress(raw)
+    if end < len(raw) and repair:
+        # only the last member can be torn by a crash during an append, cut
+        # it off so the next append starts a fresh member
+        if _member_follows(raw, end + 1):
+            raise ValueError(f"Corrupted journal member at offset {end}")
+        with open(filepath, "r+b") as f:
+            f.truncate(end)
+    tree = BranchTree()
+    count = 0
+    for line in data.splitlines():
+        if line.strip():
+            tree.apply(json.loads(line))
+            count += 1
+    if repair:
+        _set_record_count(filepath, count)
+    return tree
+
+
+def replay_journal(filepath: str, repair: bool = True) -> BranchTree:
+    """
+    Replay a journal into its branches. A torn last record is cut off with
+    `repair`, and only skipped without it, so reading a journal that is being
+    appended to never truncates it.
+    """
+    if is_compressed(filepath):
+        return _read_compressed(filepath, repair)
+    tree = BranchTree()
+    count = 0
+    offset = 0
+    torn = None
+    with open(filepath, "rb") as f:
+        for line in f:
+            if not repair and not line.endswith(b"\n"):
+                break  # being appended, or torn
+            if line.strip():
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    torn = offset
+                    break
+                tree.apply(record)
+                count += 1
+            offset += len(line)
+        rest = f.read() if torn is not None else b""
+    if torn is not None:
+        # only the last line can be torn by a crash during an append, cut it
+        # off so the next append starts on a fresh line
+        if rest.strip():
+            raise ValueError(f"Corrupted journal record at offset {torn}")
+        if not repair:
+            return tree
+        with open(filepath, "r+b") as f:
+            f.truncate(torn)
+    if repair:
+        _set_record_count(filepath, count)
+    return tree
+
+
+def read_journal(filepath: str, repair: bool = True) -> List[Dict]:
+    """Replay a journal into the messages of its checked out branch"""
+    return replay_journal(filepath, repair).messages
+
+
+def _count_records(filepath: str) -> Optional[int]:
+    """
+    Number of records in a journal, counted from its lines without decoding
+    them, or None if its last record may be torn
+    """
+    if is_compressed(filepath):
+        with open(filepath, "rb") as f:
+            raw = f.read()
+        data, end = _decompress(raw)
+        if end < len(raw):
+            return None
+        return _count_lines(data.splitlines(keepends=True))
+    with open(filepath, "rb") as f:
+        return _count_lines(f)
+
+
+def _count_lines(lines: Iterable[bytes]) -> Optional[int]:
+    count = 0
+    for line in lines:
+        if not line.endswith(b"\n"):
+            return None
+        if line.strip():
+            count += 1
+    return count
+
+
+def get_record_count(filepath: str) -> int:
+    """Number of records in a journal"""
+    with _record_counts_lock:
+        count = _record_counts.get(filepath)
+    if count is None:
+        count = _count_records(filepath)
+        if count is None:
+            # replaying repairs the torn record, and counts the others
+            read_journal(filepath)
+            with _record_counts_lock:
+                count = _record_counts[filepath]
+        else:
+            _set_record_count(filepath, count)
+    return count
+
+
+def write_journal(
+    filepath: str,
+    messages: List[Dict],
+    fsync: bool = True,
+    tree: Optional[BranchTree] = None,
+) -> None:
+    """
+    Write `messages` as a compact journal, atomically replacing `filepath`.
+    With `tree`, all of its branches are written and `messages` is ignored.
+    """
+    if tree is None:
+        records = [{"op": "append", "message": m} for m in messages]
+    else:
+        records = tree.records()
+    tmp_path = filepath + ".tmp"
+    text = "".join(_dumps(record) for record in records)
+    _write(tmp_path, "wb", text, is_compressed(filepath), fsync)
+    os.replace(tmp_path, filepath)
+    _set_record_count(filepath, len(records))
+
+
+def append_journal(
+    filepath: str,
+    records: List[Dict],
+    messages: List[Dict],
+    fsync: bool = False,
+    tree: Optional[BranchTree] = None,
+) -> bool:
+    """
+    Append `records` to the journal, `messages` (or all branches of `tree`)
+    being the state they lead to. The journal is compacted instead if it grew
+    too long. Return whether the journal was compacted.
+    """
+    count = get_record_count(filepath) + len(records)
+    size = len(messages) if tree is None else tree.size()
+    if count > COMPACT_RATIO * size + COMPACT_SLACK:
+        write_journal(filepath, messages, fsync=True, tree=tree)
+        return True
+    text = "".join(_dumps(record) for record in records)
+    _write(filepath, "ab", text, is_compressed(filepath), fsync)
+    _set_record_count(filepath, count)
+    return False
+
+
+Span = Tuple[int, int]
+
+
+def index_journal(data) -> Tuple[BranchTree, int]:
+    """
+    Find the record holding each message of the journal `data` (bytes or a
+    memory map) without decoding any message. Return the branches of the
+    journal, holding the `(start, end)` offsets of these records instead of
+    messages, and the number of records.
+    """
+    tree = BranchTree()
+    count = 0
+    start = 0
+    while start < len(data):
+        end = data.find(b"\n", start)
+        if end == -1:
+            end = len(data)
+        match = RECORD_PREFIX.match(data, start, end)
+        if match is not None:
+            record = {"op": match.group(1).decode(), "message": (start, end)}
+            if match.group(2) is not None:
+                record["index"] = int(match.group(2))
+        elif data[start:end].strip():
+            record = json.loads(data[start:end])
+            if "message" in record:
+                record["message"] = (start, end)
+        else:
+            start = end + 1
+            continue
+        tree.apply(record)
+        count += 1
+        start = end + 1
+    return tree, count
+
+
+class LazyMessages(MutableSequence):
+    """
+    Messages of a journal, each decoded from a memory map of the file only when
+    it is first accessed. Messages that were not decoded yet are kept as the
+    offsets of their record, and the map is closed once all of them are.
+    """
+
+    def __init__(self, data: mmap.mmap, spans: List[Span]) -> None:
+        self.map = data
+        self.items: List[Union[Dict, Span]] = list(spans)
+        self.encoded = len(spans)
+
+    def __decode(self, i: int) -> Dict:
+        item = self.items[i]
+        if isinstance(item, tuple):
+            start, end = item
+            item = self.items[i] = json.loads(self.map[start:end])["message"]
+            self.encoded -= 1
+            if self.encoded == 0:
+                self.map.close()
+        return item
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.__decode(j) for j in range(*i.indices(len(self.items)))]
+        return self.__decode(i)
+
+    def __setitem__(self, i, value) -> None:
+        if isinstance(i, slice):
+            self[i]  # decode the replaced messages, so they are counted
+        else:
+            self.__decode(i)
+        self.items[i] = value
+
+    def __delitem__(self, i) -> None:
+        if isinstance(i, slice):
+            self[i]
+        else:
+            self.__decode(i)
+        del self.items[i]
+
+    def insert(self, i: int, value: Dict) -> None:
+        self.items.insert(i, value)
+
+    def is_decoded(self, i: int) -> bool:
+        return not isinstance(self.items[i], tuple)
+
+    def materialize(self) -> List[Dict]:
+        """Decode all messages and return them as a plain list"""
+        return self[:]
+
+
+def open_journal(filepath: str) -> BranchTree:
+    """
+    Open an uncompressed journal for lazy reading. The messages are read at
+    once if the journal is empty, its last record is torn, or it has more than
+    one branch (which would share the decoded messages).
+    """
+    with open(filepath, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # an empty file
+            return replay_journal(filepath)
+    if data[-1:] != b"\n":
+        data.close()
+        return replay_journal(filepath)
+    try:
+        tree, count = index_journal(data)
+    except (ValueError, KeyError, IndexError):
+        data.close()
+        raise ValueError(f"Corrupted journal {filepath}")
+    if tree.branches:
+        data.close()
+        return replay_journal(filepath)
+    _set_record_count(filepath, count)
+    if not tree.messages:
+        data.close()
+    else:
+        tree.messages = LazyMessages(data, tree.messages)
+    return tree
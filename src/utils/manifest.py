@@ -0,0 +1,103 @@
+"""
+Manifest of the conversation files in the data directory.
+
+For every data file, `manifest.db` caches its title, message count, token
+total and timestamps, keyed by the modification time and size of the file.
+Listing conversations only needs a directory scan: a file is parsed again only
+if it changed since its entry was written.
+"""
+import os
+import sqlite3
+from typing import Callable, Dict, List
+
+from chatgpt_cli.context import count_message_tokens
+from utils.store import connect, get_title
+
+MANIFEST_FILENAME = "manifest.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    message_count INTEGER NOT NULL,
+    token_count INTEGER NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+UPSERT = """
+INSERT INTO conversations VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (name) DO UPDATE SET
+    mtime = excluded.mtime,
+    size = excluded.size,
+    title = excluded.title,
+    message_count = excluded.message_count,
+    token_count = excluded.token_count,
+    updated = excluded.updated
+"""
+
+
+def _conn(data_dir: str) -> sqlite3.Connection:
+    return connect(os.path.join(data_dir, MANIFEST_FILENAME), SCHEMA)
+
+
+def _entry(name: str, stat: os.stat_result, messages: List[Dict]) -> tuple:
+    tokens = sum(count_message_tokens(m) for m in messages)
+    return (
+        name,
+        stat.st_mtime,
+        stat.st_size,
+        get_title(messages),
+        len(messages),
+        tokens,
+        stat.st_mtime,  # kept from the first entry on updates
+        stat.st_mtime,
+    )
+
+
+def update_manifest(filepath: str, messages: List[Dict]) -> None:
+    """Record a data file that has just been written with `messages`"""
+    data_dir, name = os.path.split(filepath)
+    entry = _entry(name, os.stat(filepath), messages)
+    conn = _conn(data_dir)
+    with conn:
+        conn.execute(UPSERT, entry)
+
+
+def list_manifest(
+    data_dir: str,
+    is_data_file: Callable[[str], bool],
+    read: Callable[[str], List[Dict]],
+) -> List[sqlite3.Row]:
+    """
+    Entries of all data files in `data_dir`, most recently updated first.
+    Files without an up-to-date entry are read with `read(name)`, files that
+    cannot be read are listed with an empty title.
+    """
+    files = {}
+    with os.scandir(data_dir) as it:
+        for entry in it:
+            if entry.is_file() and is_data_file(entry.name):
+                files[entry.name] = entry.stat()
+    conn = _conn(data_dir)
+    cached = {
+        row["name"]: (row["mtime"], row["size"])
+        for row in conn.execute("SELECT name, mtime, size FROM conversations")
+    }
+    with conn:
+        for name in cached.keys() - files.keys():
+            conn.execute("DELETE FROM conversations WHERE name = ?", (name,))
+        for name, stat in files.items():
+            if cached.get(name) == (stat.st_mtime, stat.st_size):
+                continue
+            try:
+                messages = read(name)
+            except Exception:
+                messages = []
+            conn.execute(UPSERT, _entry(name, stat, messages))
+    return conn.execute(
+        "SELECT * FROM conversations ORDER BY updated DESC, name"
+    ).fetchall()
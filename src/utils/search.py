@@ -0,0 +1,197 @@
+"""
+Full-text search across saved conversations.
+
+Messages of every conversation in the data directory are kept in an SQLite
+FTS5 index (`search.db`). Saving a conversation updates only the messages it
+changed, and files modified outside of this tool are re-indexed when a search
+runs, based on their modification time and size.
+"""
+import os
+import sqlite3
+import time
+from typing import Dict, List
+
+from utils.store import connect
+
+INDEX_FILENAME = "search.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    name TEXT PRIMARY KEY,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    role TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_name ON entries (name, idx);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5 (
+    content, tokenize = 'unicode61'
+);
+"""
+
+# markers around matched terms in snippets, unlikely to appear in messages
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+
+
+class SearchHit:
+    def __init__(self, row: sqlite3.Row) -> None:
+        self.name = row["name"]
+        self.index = row["idx"]
+        self.role = row["role"]
+        self.snippet = row["snippet"]
+        self.score = row["score"]
+
+
+def get_index_path(data_dir: str) -> str:
+    return os.path.join(data_dir, INDEX_FILENAME)
+
+
+def _conn(data_dir: str) -> sqlite3.Connection:
+    return connect(get_index_path(data_dir), SCHEMA)
+
+
+def _insert(conn: sqlite3.Connection, name: str, index: int, message: Dict) -> None:
+    cursor = conn.execute(
+        "INSERT INTO entries (name, idx, role) VALUES (?, ?, ?)",
+        (name, index, message.get("role", "")),
+    )
+    conn.execute(
+        "INSERT INTO messages (rowid, content) VALUES (?, ?)",
+        (cursor.lastrowid, message.get("content", "")),
+    )
+
+
+def _delete(conn: sqlite3.Connection, name: str, index: int = None) -> None:
+    if index is None:
+        where, params = "name = ?", (name,)
+    else:
+        where, params = "name = ? AND idx = ?", (name, index)
+    conn.execute(
+        f"DELETE FROM messages WHERE rowid IN (SELECT id FROM entries WHERE {where})",
+        params,
+    )
+    conn.execute(f"DELETE FROM entries WHERE {where}", params)
+
+
+def _source_state(filepath: str):
+    """Modification time and size of a data file, or of the SQLite store"""
+    if os.path.exists(filepath):
+        stat = os.stat(filepath)
+        return stat.st_mtime, stat.st_size
+    return time.time(), 0
+
+
+def index_conversation(
+    filepath: str, messages: List[Dict], records: List[Dict] = None
+) -> None:
+    """
+    Index a conversation that has just been written to `filepath`. With
+    `records`, only the messages they touch are re-indexed.
+    """
+    data_dir, name = os.path.split(filepath)
+    conn = _conn(data_dir)
+    with conn:
+        known = conn.execute("SELECT 1 FROM sources WHERE name = ?", (name,)).fetchone()
+        if records is None or known is None:
+            _delete(conn, name)
+            for i, message in enumerate(messages):
+                _insert(conn, name, i, message)
+        else:
+            count = len(messages) - sum(
+                1 if r["op"] == "append" else -1 if r["op"] == "drop" else 0
+                for r in records
+            )
+            for record in records:
+                op = record["op"]
+                if op == "append":
+                    _insert(conn, name, count, record["message"])
+                    count += 1
+                elif op == "set":
+                    _delete(conn, name, record["index"])
+                    _insert(conn, name, record["index"], record["message"])
+                elif op == "drop":
+                    _delete(conn, name, record["index"])
+                    conn.execute(
+                        "UPDATE entries SET idx = idx - 1 WHERE name = ? AND idx > ?",
+                        (name, record["index"]),
+                    )
+                    count -= 1
+        mtime, size = _source_state(filepath)
+        conn.execute(
+            "INSERT OR REPLACE INTO sources (name, mtime, size) VALUES (?, ?, ?)",
+            (name, mtime, size),
+        )
+
+
+def forget_conversation(filepath: str) -> None:
+    """Mark a conversation as stale, so it is re-indexed by the next refresh"""
+    data_dir, name = os.path.split(filepath)
+    conn = _conn(data_dir)
+    with conn:
+        conn.execute("DELETE FROM sources WHERE name = ?", (name,))
+
+
+def refresh_index(data_dir: str, sources: Dict[str, tuple], read) -> int:
+    """
+    Bring the index up to date with `sources`, a mapping from conversation
+    names to their `(mtime, size)`. Conversations that changed are read with
+    `read(name)` and re-indexed, deleted ones are removed. Return the number
+    of re-indexed conversations.
+    """
+    conn = _conn(data_dir)
+    indexed = {
+        row["name"]: (row["mtime"], row["size"])
+        for row in conn.execute("SELECT name, mtime, size FROM sources")
+    }
+    count = 0
+    for name in indexed.keys() - sources.keys():
+        with conn:
+            _delete(conn, name)
+            conn.execute("DELETE FROM sources WHERE name = ?", (name,))
+    for name, state in sources.items():
+        old = indexed.get(name)
+        # conversations in the SQLite store have no size, only an update time
+        if old is not None and old[0] >= state[0] and old[1] in [state[1], 0]:
+            continue
+        try:
+            messages = read(name)
+        except Exception:
+            continue
+        with conn:
+            _delete(conn, name)
+            for i, message in enumerate(messages):
+                _insert(conn, name, i, message)
+            conn.execute(
+                "INSERT OR REPLACE INTO sources (name, mtime, size) VALUES (?, ?, ?)",
+                (name, state[0], state[1]),
+            )
+        count += 1
+    return count
+
+
+def fts_query(query: str) -> str:
+    """Quote every term, so user input is never parsed as FTS5 syntax"""
+    return " ".join('"' + term.replace('"', '""') + '"' for term in query.split())
+
+
+def search(data_dir: str, query: str, limit: int = 20) -> List[SearchHit]:
+    """Messages matching all terms of `query`, best matches first"""
+    if not query.split():
+        return []
+    rows = _conn(data_dir).execute(
+        f"""
+        SELECT e.name, e.idx, e.role, bm25(messages) AS score,
+            snippet(messages, 0, '{MATCH_START}', '{MATCH_END}', '...', 16) AS snippet
+        FROM messages JOIN entries e ON e.id = messages.rowid
+        WHERE messages MATCH ?
+        ORDER BY score
+        LIMIT ?
+        """,
+        (fts_query(query), limit),
+    )
+    return [SearchHit(row) for row in rows]
@@ -0,0 +1,187 @@
+"""
+Settings read from `config.yaml` and `patch.yaml`.
+
+Both files are parsed and validated once and kept as read-only mappings
+(see `get_config` and `get_patch`). A file is only read again after its modification time or size
+changed, and the config directory is resolved (and created) once per process,
+so looking up settings never re-parses YAML or probes the directory tree.
+"""
+import functools
+import os
+import types
+from typing import Any, Dict, Optional, Tuple
+
+import yaml
+
+# expected type of each setting, given by its dotted path; sections and
+# options that are missing or empty fall back to the defaults of their module
+CONFIG_SCHEMA = {
+    "openai": dict,
+    "openai.api_key": str,
+    "openai.default_prompt": list,
+    "proxy": dict,
+    "proxy.http_proxy": str,
+    "proxy.https_proxy": str,
+    "chat": dict,
+    "chat.use_streaming": bool,
+    "chat.model": str,
+    "chat.refresh_per_second": (int, float),
+    "client": dict,
+    "retry": dict,
+    "rate_limit": dict,
+    "context": dict,
+    "storage": dict,
+    "cache": dict,
+    "batch": dict,
+}
+REQUIRED_CONFIG = ["openai.api_key", "openai.default_prompt"]
+
+PATCH_SCHEMA = {"templates": list}
+TEMPLATE_SCHEMA = {
+    "name": str,
+    "alias": str,
+    "description": str,
+    "prompts": list,
+    "references": list,
+}
+
+ROLES = ["system", "user", "assistant"]
+
+_files: Dict[str, "SettingsFile"] = {}
+
+
+@functools.lru_cache(maxsize=None)
+def get_config_dir() -> str:
+    """Config directory: `${HOME}/.config/chatgpt-cli`"""
+    config_dir = os.path.join(os.path.expanduser("~"), ".config", "chatgpt-cli")
+    os.makedirs(config_dir, exist_ok=True)
+    return config_dir
+
+
+def get_config_path() -> str:
+    return os.path.join(get_config_dir(), "config.yaml")
+
+
+def get_patch_path() -> str:
+    return os.path.join(get_config_dir(), "patch.yaml")
+
+
+def freeze(value: Any) -> Any:
+    """Read-only copy of parsed YAML: dicts become mapping proxies, lists tuples"""
+    if isinstance(value, dict):
+        return types.MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def thaw(value: Any) -> Any:
+    """Mutable deep copy of a frozen value"""
+    if isinstance(value, types.MappingProxyType):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    return value
+
+
+def _lookup(data: Dict, key: str) -> Any:
+    for part in key.split("."):
+        if not isinstance(data, dict):
+            return None
+        data = data.get(part)
+    return data
+
+
+def _check_types(data: Dict, schema: Dict, where: str) -> None:
+    for key, expected in schema.items():
+        value = _lookup(data, key)
+        if value is not None and not isinstance(value, expected):
+            names = expected if isinstance(expected, tuple) else (expected,)
+            raise ValueError(
+                f"`{key}` in {where} should be a {' or '.join(t.__name__ for t in names)}"
+            )
+
+
+def _check_messages(messages: list, key: str, where: str) -> None:
+    for i, message in enumerate(messages):
+        if (
+            not isinstance(message, dict)
+            or message.get("role") not in ROLES
+            or not isinstance(message.get("content"), str)
+        ):
+            raise ValueError(
+                f"`{key}[{i}]` in {where} should be a message with a role in {ROLES} and a content"
+            )
+
+
+def validate_config(config: Dict, path: str) -> None:
+    if not isinstance(config, dict):
+        raise ValueError(f"{path} should contain a mapping")
+    _check_types(config, CONFIG_SCHEMA, path)
+    for key in REQUIRED_CONFIG:
+        if not _lookup(config, key):
+            raise ValueError(f"`{key}` is missing or empty in {path}")
+    _check_messages(config["openai"]["default_prompt"], "openai.default_prompt", path)
+
+
+def validate_patch(patch: Dict, path: str) -> None:
+    if not isinstance(patch, dict):
+        raise ValueError(f"{path} should contain a mapping")
+    _check_types(patch, PATCH_SCHEMA, path)
+    for i, template in enumerate(patch.get("templates") or []):
+        where = f"`templates[{i}]` of {path}"
+        if not isinstance(template, dict) or not template.get("name"):
+            raise ValueError(f"{where} should be a mapping with a `name`")
+        _check_types(template, TEMPLATE_SCHEMA, where)
+        _check_messages(template.get("prompts") or [], "prompts", where)
+
+
+def _stamp(path: str) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class SettingsFile:
+    """A YAML file, parsed and validated again only after it changed"""
+
+    def __init__(self, path: str, validate) -> None:
+        self.path = path
+        self.validate = validate
+        self.stamp = None
+        self.data = None
+
+    def get(self) -> types.MappingProxyType:
+        stamp = _stamp(self.path)
+        if self.data is None or stamp != self.stamp:
+            data = {}
+            if stamp is not None:
+                with open(self.path, "r") as f:
+                    data = yaml.safe_load(f)
+            if data is None:
+                data = {}  # an empty file
+            self.validate(data, self.path)
+            self.data = freeze(data)
+            self.stamp = stamp
+        return self.data
+
+
+def _file(path: str, validate) -> SettingsFile:
+    if path not in _files:
+        _files[path] = SettingsFile(path, validate)
+    return _files[path]
+
+
+def get_config() -> types.MappingProxyType:
+    """
+    Contents of `config.yaml`. Raises `yaml.YAMLError` or `ValueError` if it
+    cannot be parsed or is invalid, the same applies to `get_patch`.
+    """
+    return _file(get_config_path(), validate_config).get()
+
+
+def get_patch() -> types.MappingProxyType:
+    """Contents of `patch.yaml`, empty if there is none"""
+    return _file(get_patch_path(), validate_patch).get()
@@ -0,0 +1,193 @@
+"""
+SQLite store for conversations.
+
+All conversations live in one `conversations.db` file in the data directory.
+Listing reads a single indexed table instead of every file, and saving a turn
+only inserts or updates the changed message rows.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+STORE_FILENAME = "conversations.db"
+
+# message keys stored in their own columns, others are kept as JSON in `extra`
+MESSAGE_COLUMNS = ["role", "content"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    title TEXT NOT NULL DEFAULT '',
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    token_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS conversations_created ON conversations (created);
+CREATE INDEX IF NOT EXISTS conversations_updated ON conversations (updated);
+CREATE INDEX IF NOT EXISTS conversations_title ON conversations (title);
+CREATE TABLE IF NOT EXISTS messages (
+    conversation_id INTEGER NOT NULL REFERENCES conversations (id) ON DELETE CASCADE,
+    idx INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    extra TEXT
+);
+CREATE INDEX IF NOT EXISTS messages_conversation ON messages (conversation_id, idx);
+"""
+
+TITLE_LENGTH = 80
+
+# sqlite connections cannot be shared between threads (e.g. the autosave
+# writer), so each thread keeps its own connection per database
+_local = threading.local()
+
+
+def connect(path: str, schema: str = SCHEMA) -> sqlite3.Connection:
+    """Connection of the current thread to the database at `path`"""
+    connections = _local.__dict__.setdefault("connections", {})
+    conn = connections.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA foreign_keys = ON")
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.executescript(schema)
+        connections[path] = conn
+    return conn
+
+
+def get_title(messages: List[Dict]) -> str:
+    """Title of a conversation: the beginning of its first user message"""
+    for message in messages:
+        if message.get("role") == "user":
+            title = " ".join(message.get("content", "").split())
+            if len(title) > TITLE_LENGTH:
+                title = title[: TITLE_LENGTH - 3] + "..."
+            return title
+    return ""
+
+
+def _row(conversation_id: int, index: int, message: Dict) -> tuple:
+    extra = {k: v for k, v in message.items() if k not in MESSAGE_COLUMNS}
+    return (
+        conversation_id,
+        index,
+        message.get("role", ""),
+        message.get("content", ""),
+        json.dumps(extra, ensure_ascii=False) if extra else None,
+    )
+
+
+def _message(row: sqlite3.Row) -> Dict:
+    message = {"role": row["role"], "content": row["content"]}
+    if row["extra"]:
+        message.update(json.loads(row["extra"]))
+    return message
+
+
+class ConversationStore:
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        return connect(self.path)
+
+    def __conversation_id(self, name: str) -> Optional[int]:
+        row = self.conn.execute(
+            "SELECT id FROM conversations WHERE name = ?", (name,)
+        ).fetchone()
+        return row["id"] if row is not None else None
+
+    def exists(self, name: str) -> bool:
+        return self.__conversation_id(name) is not None
+
+    def save(self, name: str, messages: List[Dict], records: List[Dict] = None) -> None:
+        """
+        Save `messages` as conversation `name`. If the conversation exists and
+        `records` (the journal records leading to `messages`) are given, only
+        the rows they touch are written.
+        """
+        now = time.time()
+        tokens = sum(m.get("tokens") or 0 for m in messages)
+        with self.conn as conn:
+            conversation_id = self.__conversation_id(name)
+            if conversation_id is None:
+                cursor = conn.execute(
+                    "INSERT INTO conversations (name, created, updated) VALUES (?, ?, ?)",
+                    (name, now, now),
+                )
+                conversation_id = cursor.lastrowid
+                records = None
+            if records is None:
+                conn.execute(
+                    "DELETE FROM messages WHERE conversation_id = ?",
+                    (conversation_id,),
+                )
+                conn.executemany(
+                    "INSERT INTO messages VALUES (?, ?, ?, ?, ?)",
+                    [_row(conversation_id, i, m) for i, m in enumerate(messages)],
+                )
+            else:
+                self.__apply(conversation_id, records)
+            conn.execute(
+                "UPDATE conversations SET title = ?, updated = ?, message_count = ?, token_count = ? WHERE id = ?",
+                (get_title(messages), now, len(messages), tokens, conversation_id),
+            )
+
+    def __apply(self, conversation_id: int, records: List[Dict]) -> None:
+        conn = self.conn
+        for record in records:
+            op = record["op"]
+            if op == "append":
+                count = conn.execute(
+                    "SELECT COALESCE(MAX(idx) + 1, 0) FROM messages WHERE conversation_id = ?",
+                    (conversation_id,),
+                ).fetchone()[0]
+                conn.execute(
+                    "INSERT INTO messages VALUES (?, ?, ?, ?, ?)",
+                    _row(conversation_id, count, record["message"]),
+                )
+            elif op == "set":
+                row = _row(conversation_id, record["index"], record["message"])
+                conn.execute(
+                    "UPDATE messages SET role = ?, content = ?, extra = ? WHERE conversation_id = ? AND idx = ?",
+                    row[2:] + row[:2],
+                )
+            elif op == "drop":
+                conn.execute(
+                    "DELETE FROM messages WHERE conversation_id = ? AND idx = ?",
+                    (conversation_id, record["index"]),
+                )
+                conn.execute(
+                    "UPDATE messages SET idx = idx - 1 WHERE conversation_id = ? AND idx > ?",
+                    (conversation_id, record["index"]),
+                )
+            else:
+                raise ValueError(f"Invalid journal record: {record}")
+
+    def load(self, name: str) -> List[Dict]:
+        conversation_id = self.__conversation_id(name)
+        if conversation_id is None:
+            raise KeyError(name)
+        rows = self.conn.execute(
+            "SELECT role, content, extra FROM messages WHERE conversation_id = ? ORDER BY idx",
+            (conversation_id,),
+        )
+        return [_message(row) for row in rows]
+
+    def list(self, limit: int = None) -> List[sqlite3.Row]:
+        """Conversations, most recently updated first"""
+        query = "SELECT name, title, created, updated, message_count, token_count FROM conversations ORDER BY updated DESC"
+        if limit is not None:
+            return self.conn.execute(query + " LIMIT ?", (limit,)).fetchall()
+        return self.conn.execute(query).fetchall()
+
+
+def get_store(data_dir: str) -> ConversationStore:
+    return ConversationStore(os.path.join(data_dir, STORE_FILENAME))
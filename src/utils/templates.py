@@ -0,0 +1,77 @@
+"""
+Templates from `patch.yaml`, indexed by name and alias.
+
+The registry is built once from the parsed patch file and rebuilt only after
+`patch.yaml` changed on disk, so a template added with `!tmpl create` or in an
+editor is found by the next lookup without restarting the CLI.
+"""
+import types
+from typing import Dict, List, Optional
+
+import yaml
+
+from utils.io import print, printmd
+from utils.settings import get_patch, get_patch_path
+
+_registry = None
+
+
+class TemplateRegistry:
+    def __init__(self) -> None:
+        self.patch = None
+        self.templates: List[types.MappingProxyType] = []
+        self.index: Dict[str, types.MappingProxyType] = {}
+
+    def __build(self, patch: types.MappingProxyType) -> None:
+        templates = list(patch.get("templates") or [])
+        index = {}
+        # names are indexed first, so a name always wins over an equal alias
+        for template in templates:
+            index.setdefault(template["name"], template)
+        for template in templates:
+            if template.get("alias"):
+                index.setdefault(template["alias"], template)
+        self.templates = templates
+        self.index = index
+        self.patch = patch
+
+    def refresh(self) -> None:
+        """Rebuild the index if `patch.yaml` changed since the last lookup"""
+        try:
+            patch = get_patch()
+        except (yaml.YAMLError, ValueError) as e:
+            if self.patch is None:
+                raise
+            printmd(
+                f"**[Warning]**: Keeping the templates loaded before, `{get_patch_path()}` is invalid: {e}"
+            )
+            return
+        if patch is not self.patch:
+            self.__build(patch)
+
+    def get(self, key: str) -> Optional[types.MappingProxyType]:
+        """The template named or aliased `key`, or None"""
+        return self.index.get(key)
+
+    def __len__(self) -> int:
+        return len(self.templates)
+
+    def __getitem__(self, i: int) -> types.MappingProxyType:
+        return self.templates[i]
+
+
+def get_template_registry() -> TemplateRegistry:
+    """Return the shared registry, up to date with `patch.yaml`"""
+    global _registry
+    if _registry is None:
+        registry = TemplateRegistry()
+        try:
+            registry.refresh()
+        except (yaml.YAMLError, ValueError) as e:
+            print("Error in patch file:", get_patch_path())
+            printmd(f"**[Error]**: {e}")
+            exit(1)
+        _registry = registry
+    else:
+        _registry.refresh()
+    return _registry
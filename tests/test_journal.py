@@ -0,0 +1,21 @@
+from utils.journal import LazyMessages, open_journal, write_journal
+
+
+def test_journal_messages_are_decoded_lazily(tmp_path):
+    path = str(tmp_path / "lazy.jsonl")
+    messages = [{"role": "user", "content": f"message {i}"} for i in range(10)]
+    write_journal(path, messages)
+
+    tree = open_journal(path)
+    lazy = tree.messages
+    assert isinstance(lazy, LazyMessages)
+    assert len(lazy) == 10
+    assert not any(lazy.is_decoded(i) for i in range(10))
+
+    assert lazy[3] == messages[3]
+    assert [lazy.is_decoded(i) for i in range(10)] == [i == 3 for i in range(10)]
+    assert not lazy.map.closed
+
+    assert lazy.materialize() == messages
+    assert all(lazy.is_decoded(i) for i in range(10))
+    assert lazy.map.closed
@@ -0,0 +1,52 @@
+from chatgpt_cli import conversation
+from chatgpt_cli.conversation import Conversation
+from utils.journal import BranchTree
+
+
+def make_conversation() -> Conversation:
+    conv = Conversation([{"role": "system", "content": "You are a test."}], False)
+    conv.snapshot = False  # record the changes, as after a first save
+    conv.add_user_message("hello")
+    conv.add_assistant_message("first")
+    return conv
+
+
+def regenerate(monkeypatch, conv: Conversation, candidates, selected) -> None:
+    def generate_candidates(messages, count, use_streaming, model):
+        yield from enumerate(candidates)
+
+    monkeypatch.setattr(conversation, "generate_candidates", generate_candidates)
+    monkeypatch.setattr(conversation, "pick_candidate", lambda c, keep: selected)
+    conv.regenerate_candidates(len(candidates))
+
+
+def test_regen_keeps_other_candidates_in_branches(monkeypatch):
+    conv = make_conversation()
+    regenerate(monkeypatch, conv, ["second", "third", "second"], 1)
+    assert conv.messages[-1]["content"] == "third"
+    assert conv.branch == "main"
+    assert conv.tree.names() == ["main", "regen-1", "regen-2"]
+    kept = [conv.tree.get(name)[-1]["content"] for name in ["regen-1", "regen-2"]]
+    assert kept == ["first", "second"]
+    for name in ["regen-1", "regen-2"]:
+        assert list(conv.tree.get(name)[:2]) == list(conv.messages[:2])
+
+    # the journal records lead to the same branches
+    tree = BranchTree()
+    for message in conv.default_prompt:
+        tree.apply({"op": "append", "message": message})
+    for record in conv.pending:
+        tree.apply(record)
+    assert tree.names() == conv.tree.names()
+    for name in tree.names():
+        assert list(tree.get(name)) == list(conv.tree.get(name))
+
+
+def test_regen_keeping_current_response(monkeypatch):
+    conv = make_conversation()
+    regenerate(monkeypatch, conv, ["first", "other"], None)
+    assert conv.messages[-1]["content"] == "first"
+    assert conv.tree.names() == ["main", "regen-1"]
+    assert conv.tree.get("regen-1")[-1]["content"] == "other"
+    conv.checkout("regen-1")
+    assert [m["content"] for m in conv.messages[1:]] == ["hello", "other"]
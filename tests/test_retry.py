@@ -0,0 +1,19 @@
+import openai
+
+from chatgpt_cli.retry import RetryPolicy
+
+
+def test_retry_after_is_capped_at_max_delay():
+    policy = RetryPolicy({"max_delay": 30})
+    err = openai.error.RateLimitError("slow down", headers={"Retry-After": "86400"})
+    assert policy.delay(err, 1) == 30
+    err = openai.error.RateLimitError("slow down", headers={"Retry-After": "2"})
+    assert policy.delay(err, 1) == 2
+
+
+def test_stats_show_retried_errors():
+    policy = RetryPolicy()
+    policy.wait(openai.error.RateLimitError("slow down"), 0)
+    policy.wait(openai.error.Timeout("timed out"), 0)
+    policy.wait(openai.error.RateLimitError("slow down"), 0)
+    assert str(policy.stats).startswith("3 retries (2 RateLimitError, 1 Timeout), ")
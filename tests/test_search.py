@@ -0,0 +1,17 @@
+from utils.file import get_data_path, search_data, write_data
+from utils.io import console
+
+
+def test_search_query_with_brackets(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    messages = [
+        {"role": "user", "content": "what does [/u1] mean?"},
+        {"role": "assistant", "content": "It closes a [u1] markup tag."},
+    ]
+    write_data(messages, get_data_path("brackets"))
+    with console.capture() as capture:
+        search_data("[/u1]")
+        search_data("[bold]nothing[/bold]")
+    output = capture.get()
+    assert "Messages matching '[/u1]'" in output
+    assert "[bold]nothing[/bold]" in output